@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+from custom_logger import CustomLogger
+
+"""
+Runs timed macro steps (WAIT: between them) at their due time.
+
+Steps sit in a heap keyed by due time. The scheduler thread waits on a condition until shortly before the
+next step is due, so an idle scheduler or a long WAIT: costs no CPU. A condition wait can oversleep by a
+scheduler tick, about 15.6 ms on Windows, so the wait ends SPIN_THRESHOLD before the due time. The rest is
+slept off with time.sleep, which uses a high resolution timer (on Windows from Python 3.11 on), and the last
+SLEEP_MARGIN is spent spinning on the clock. The spin yields the GIL on every turn so the socket threads keep
+running. A thread that keeps the GIL busy can still hold a step back by up to sys.getswitchinterval().
+
+The clock is time.perf_counter: monotonic like time.monotonic, but with the high resolution timer on every
+platform (time.monotonic only ticks every ~16 ms on Windows).
+
+Every step records its lateness (actual minus due time) in the PerfStats stage "schedule_error" and steps
+later than LATE_THRESHOLD are counted.
+
+Steps are scheduled on a lane, one per connection. Timed sequences of a lane run one after the other, a
+sequence scheduled while another one of its lane is still running starts when that one ends, and busy()
+tells the caller to queue untimed steps behind it too. Lanes don't wait for each other.
+"""
+
+clock = time.perf_counter
+
+if sys.platform == "win32":
+    # Condition waits only wake on the system tick
+    SPIN_THRESHOLD = 0.02
+    # time.sleep only got the high resolution timer in Python 3.11, before that it is as coarse as a wait
+    SLEEP_MARGIN = 0.0015 if sys.version_info >= (3, 11) else SPIN_THRESHOLD
+else:
+    SPIN_THRESHOLD = 0.002
+    SLEEP_MARGIN = 0.001
+# Steps running this much after their due time count as late
+LATE_THRESHOLD = 0.001
+WAIT_TYPE = "wait"
+
+
+def timeline(items, payload=lambda item: item):
+    """
+    (offset in seconds, item) for every item that is not a wait, the waits before an item add up to its offset.
+    payload gets the payload dict out of an item, for items that are not payloads themselves
+    """
+    offset = 0.0
+    entries = []
+    for item in items:
+        step = payload(item)
+        if step.get("type") == WAIT_TYPE:
+            offset += step["data"] / 1000
+        else:
+            entries.append((offset, item))
+    return entries, offset
+
+
+class ActionScheduler:
+    def __init__(self, sink, stats=None, name="ActionScheduler", spin_threshold=SPIN_THRESHOLD,
+                 sleep_margin=SLEEP_MARGIN):
+        self.logger = CustomLogger().get_logger("ActionSchedulerClassLogger")
+        self.event_logger = CustomLogger().get_sampled_logger("ActionSchedulerClassLogger")
+        self.sink = sink
+        self.stats = stats
+        self.name = name
+        self.spin_threshold = spin_threshold
+        self.sleep_margin = min(sleep_margin, spin_threshold)
+        self.heap = []
+        # Ties on the due time keep the order the steps were scheduled in
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        # Lane -> end of its last scheduled sequence, the lane's next one starts no earlier
+        self.busy_until = {}
+        # Lane -> steps scheduled but not handed to the sink yet
+        self.lane_pending = {}
+        self.closed = False
+        self.thread = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+        self.logger.info(f"{self.name} started")
+
+    def close(self, flush=None):
+        """
+        Stop the scheduler, pending steps are dropped. Those flush(item) is true for go to the sink right away,
+        in due order, so a key_up still waiting behind a WAIT: does not leave its key held
+        """
+        with self.condition:
+            self.closed = True
+            flushed = []
+            if flush is not None:
+                flushed = [item for _, _, _, item in sorted(self.heap) if flush(item)]
+                self.heap = [entry for entry in self.heap if not flush(entry[3])]
+                heapq.heapify(self.heap)
+            self.condition.notify()
+        for item in flushed:
+            try:
+                self.sink(item)
+            except Exception as e:
+                self.event_logger.error("Flushing step %s failed: %s", item, e)
+        if flushed:
+            self.logger.info(f"{self.name} flushed {len(flushed)} steps on close")
+
+    def pending(self):
+        return len(self.heap)
+
+    def busy(self, lane=None):
+        """True while the lane has steps left or its last sequence has not ended, later steps go behind it"""
+        with self.condition:
+            return self.lane_pending.get(lane, 0) > 0 or self.busy_until.get(lane, 0.0) > clock()
+
+    def release(self, lane):
+        """Forget a closed connection's lane, steps it still has run as scheduled"""
+        with self.condition:
+            self.busy_until.pop(lane, None)
+
+    def schedule(self, entries, duration=0.0, lane=None):
+        """
+        Schedule (offset in seconds, item) entries, see timeline(). duration is the length of the whole sequence,
+        trailing waits included, the lane's next sequence starts after it. Returns the start time
+        """
+        with self.condition:
+            start = max(clock(), self.busy_until.get(lane, 0.0))
+            for offset, item in entries:
+                heapq.heappush(self.heap, (start + offset, next(self.counter), lane, item))
+            self.lane_pending[lane] = self.lane_pending.get(lane, 0) + len(entries)
+            self.busy_until[lane] = start + max(duration, entries[-1][0] if entries else 0.0)
+            self.condition.notify()
+        return start
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self.heap:
+                    self.condition.wait()
+                if self.closed:
+                    break
+                due = self.heap[0][0]
+                remaining = due - clock()
+                if remaining > self.spin_threshold:
+                    # Woken early by schedule() if an earlier step came in, the loop then looks again
+                    self.condition.wait(remaining - self.spin_threshold)
+                    continue
+                if remaining <= self.sleep_margin:
+                    _, _, lane, item = heapq.heappop(self.heap)
+            if remaining > self.sleep_margin:
+                # Outside the lock so schedule() is not held up, the heap is looked at again afterwards
+                time.sleep(remaining - self.sleep_margin)
+                continue
+            now = clock()
+            while now < due:
+                time.sleep(0)
+                now = clock()
+            self.fire(item, now - due)
+            self.step_done(lane)
+        self.logger.info(f"{self.name} stopped, {len(self.heap)} steps dropped")
+
+    def step_done(self, lane):
+        with self.condition:
+            left = self.lane_pending[lane] - 1
+            if left:
+                self.lane_pending[lane] = left
+                return
+            del self.lane_pending[lane]
+            if self.busy_until.get(lane, 0.0) <= clock():
+                # Idle lane, nothing to keep for it
+                self.busy_until.pop(lane, None)
+
+    def fire(self, item, lateness):
+        if self.stats is not None:
+            self.stats.record("schedule_error", int(lateness * 1_000_000_000))
+            if lateness > LATE_THRESHOLD:
+                self.stats.increment("late_steps")
+        try:
+            self.sink(item)
+        except Exception as e:
+            if self.stats is not None:
+                self.stats.increment("schedule_failures")
+            self.event_logger.error("Scheduled step %s failed: %s", item, e)
@@ -0,0 +1,229 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from action_scheduler import WAIT_TYPE
+from custom_logger import CustomLogger
+from framing import enable_keepalive, encode_frame, read_frame_async, send_frame_async, split_sequence
+from input_injector import MOUSE_TYPES
+from macro_sync import apply_sync_macros, apply_snapshot, build_sync_state
+from payload_codec import JSON_CODEC, choose_codec
+from session_registry import RESUME_PREFIX, RESUMED_PREFIX
+from socket_server import Server, generate_challenge, validate_response, AUTH_TIMEOUT, INJECTION_TYPES, \
+    constants_manager, is_key_up
+
+# Getting a logger for the modulw level logging
+module_logger = CustomLogger().get_logger("AsyncServerModuleLogger")
+
+
+class ClientSession:
+    """Per connection state, each connected master gets its own"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.authenticated = False
+        self.frames_received = 0
+        self.closing = False
+        self.codec = JSON_CODEC
+        # ResumableSession once the client said hello or resumed, shared with the server's registry
+        self.resumable = None
+        self.ack_pending = False
+
+    def __repr__(self):
+        return f"ClientSession(peer={self.peer}, authenticated={self.authenticated})"
+
+
+class AsyncServer(Server):
+    """
+    asyncio flavour of Server that serves any number of masters at once.
+
+    Networking, authentication and payload decoding run on the event loop, the
+    input injection goes through the InputInjector thread and DB writes run on a
+    single worker thread, so no client can stall the loop.
+    """
+
+    def __init__(self, host, port, db_manager, datagrams=False):
+        super().__init__(host, port, db_manager, datagrams=datagrams)
+        self.logger = CustomLogger().get_logger("AsyncServerClassLogger")
+        self.event_logger = CustomLogger().get_sampled_logger("AsyncServerClassLogger")
+        self.sessions = set()
+        self.loop = None
+        self.aio_server = None
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AsyncServerWorker")
+
+    def start(self):
+        self.injector.start()
+        self.scheduler.start()
+        try:
+            # The lane has its own thread, datagrams go straight to the injector and never touch the loop
+            self.start_datagram_lane()
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.logger.error(f"Error in async server: {e}")
+        finally:
+            self.scheduler.close(flush=is_key_up)
+            self.injector.close()
+            self.worker.shutdown(wait=False)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.aio_server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.logger.info(f"Async server started on {self.host}:{self.port} and waiting for connections...")
+        async with self.aio_server:
+            try:
+                await self.aio_server.serve_forever()
+            except asyncio.CancelledError:
+                self.logger.info("Async server stopped")
+
+    def close(self):
+        constants_manager.unsubscribe('BUFFER_SIZE', self.on_buffer_size_changed)
+        if self.datagram_receiver is not None:
+            self.datagram_receiver.close()
+        if self.macro_table is not None:
+            self.macro_table.close()
+        if self.loop is None or self.aio_server is None:
+            return
+        self.logger.info("Closing async server")
+        self.loop.call_soon_threadsafe(self.aio_server.close)
+        for session in list(self.sessions):
+            self.loop.call_soon_threadsafe(session.writer.close)
+
+    async def handle_connection(self, reader, writer):
+        session = ClientSession(reader, writer)
+        self.sessions.add(session)
+        self.logger.info(f"Connection from {session.peer}, {len(self.sessions)} client(s) connected")
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # Lets the OS notice masters that vanished without closing the connection
+            enable_keepalive(sock)
+        try:
+            if await asyncio.wait_for(self.authenticate(session), AUTH_TIMEOUT):
+                session.authenticated = True
+                if session.resumable is not None:
+                    session.codec = session.resumable.codec
+                    await send_frame_async(writer, f"{RESUMED_PREFIX}{session.resumable.last_sequence}")
+                else:
+                    self.logger.info(f"Authentication successful for {session.peer}")
+                    await send_frame_async(writer, constants_manager.get('AUTH_SUCCESS'))
+                await self.main_server_loop(session)
+            else:
+                self.logger.error(f"Authentication failed for {session.peer}")
+                await send_frame_async(writer, constants_manager.get('AUTH_FAILED'))
+        except asyncio.TimeoutError:
+            self.logger.warning(f"{session.peer} did not authenticate within {AUTH_TIMEOUT}s")
+        except ConnectionError as e:
+            self.logger.warning(f"Connection with {session.peer} lost: {e}")
+        except Exception as e:
+            self.logger.error(f"Error while serving {session.peer}: {e}")
+        finally:
+            await self.teardown(session)
+
+    async def teardown(self, session):
+        self.sessions.discard(session)
+        self.scheduler.release(session.resumable or session)
+        session.writer.close()
+        try:
+            await session.writer.wait_closed()
+        except Exception as e:
+            self.logger.debug(f"Ignoring error while closing {session.peer}: {e}")
+        self.logger.info(f"{session.peer} disconnected, {len(self.sessions)} client(s) connected")
+
+    async def authenticate(self, session):
+        challenge = generate_challenge()
+        await send_frame_async(session.writer, challenge)
+        response = await read_frame_async(session.reader)
+        if response is None:
+            return False
+        response = response.decode()
+        if response.startswith(RESUME_PREFIX):
+            session.resumable = self.session_registry.resume(response, challenge)
+            return session.resumable is not None
+        return validate_response(response, challenge)
+
+    async def main_server_loop(self, session):
+        while not session.closing:
+            frame = await read_frame_async(session.reader)
+            if frame is None:
+                self.logger.warning(f"Connection lost with client {session.peer}")
+                break
+            session.frames_received += 1
+            self.stats.increment("frames")
+            self.stats.increment("bytes_received", len(frame))
+            if session.resumable is not None:
+                sequence, frame = split_sequence(frame)
+                if not session.resumable.accept(sequence):
+                    self.stats.increment("duplicates")
+                    continue
+                if not session.ack_pending:
+                    # Runs once this loop has to wait for more data, so a burst of frames gets one ack
+                    session.ack_pending = True
+                    self.loop.call_soon(self.send_ack, session)
+            await self.process_received_payload(frame, session)
+
+    def send_ack(self, session):
+        session.ack_pending = False
+        if session.resumable is None or session.writer.is_closing():
+            return
+        session.writer.write(encode_frame(session.codec.encode({"type": "ack",
+                                                                 "data": session.resumable.last_sequence})))
+
+    async def submit(self, payload):
+        if not self.injector.try_submit(payload):
+            # Injection is falling behind, wait for room off the loop so the other sessions keep being served
+            await self.loop.run_in_executor(self.worker, self.injector.submit, payload)
+
+    async def process_received_payload(self, data_received, session):
+        start = time.perf_counter_ns()
+        payload = session.codec.decode(data_received)
+        decoded = self.stats.record_since("decode", start)
+        self.event_logger.info("Received from %s payload: %s", session.peer, payload)
+        payload_type = payload.get("type")
+        # Every master gets its own scheduler lane, one master's timed macros never hold up another's
+        lane = session.resumable or session
+        if payload_type == "SYNC_MACROS":
+            self.logger.info(f"Sync Macros requested by {session.peer}")
+            await self.loop.run_in_executor(self.worker, apply_sync_macros, self.db_manager, payload)
+        elif payload_type == "SYNC_HELLO":
+            state = await self.loop.run_in_executor(self.worker, build_sync_state, self.db_manager,
+                                                    payload["data"]["db_id"])
+            await send_frame_async(session.writer, session.codec.encode(state))
+        elif payload_type == "SYNC_SNAPSHOT":
+            self.logger.info(f"Snapshot of {len(payload['data']['macros'])} macros received from {session.peer}")
+            await self.loop.run_in_executor(self.worker, apply_snapshot, self.db_manager, payload)
+        elif payload_type == "codec":
+            session.codec = choose_codec(payload["data"])
+            self.logger.info(f"{session.peer} offered codecs {payload['data']}, using {session.codec.name}")
+            await send_frame_async(session.writer, session.codec.name)
+        elif payload_type == "exit":
+            self.logger.info(f"{session.peer} asked to exit")
+            session.closing = True
+        elif payload_type == "stats":
+            stats = self.collect_stats()
+            stats["sessions"] = len(self.sessions)
+            await send_frame_async(session.writer, session.codec.encode({"type": "stats", "data": stats}))
+        elif payload_type == "hello":
+            session.resumable = self.session_registry.create(session.codec)
+            await send_frame_async(session.writer, session.codec.encode(self.hello_reply(session.resumable)))
+        elif payload_type == "run_macro":
+            # The table may have to read the DB, that happens on the worker behind any pending sync
+            payloads = await self.loop.run_in_executor(self.worker, self.expand_macro, payload["data"])
+            if payloads is None:
+                await send_frame_async(session.writer, session.codec.encode({"type": "macro_miss",
+                                                                             "data": payload["data"]}))
+            elif any(step["type"] == WAIT_TYPE for step in payloads):
+                self.schedule_sequence(payloads, lane)
+            elif not self.queue_behind_sequence(payloads, lane):
+                for step in payloads:
+                    await self.submit(step)
+        elif payload_type == "sequence":
+            self.schedule_sequence(payload["data"], lane)
+        elif payload_type in MOUSE_TYPES:
+            await self.submit(payload)
+        elif payload_type in INJECTION_TYPES:
+            if not self.queue_behind_sequence([payload], lane):
+                await self.submit(payload)
+        else:
+            self.event_logger.warning("Unknown payload type: %s", payload_type)
+        self.stats.record_since("dispatch", decoded)
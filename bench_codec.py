@@ -0,0 +1,64 @@
+import argparse
+import json
+import time
+
+from payload_codec import JSON_CODEC, BINARY_CODEC
+
+"""
+Compares encode/decode throughput and payload size of the JSON and binary codecs.
+
+Usage:
+    python bench_codec.py [--iterations 200000] [--json]
+"""
+
+SAMPLE_PAYLOADS = {
+    "mouse_move_rel": {"type": "mouse_move_rel", "data": {"dx": -3, "dy": 7}},
+    "mouse_move": {"type": "mouse_move", "data": {"x": 1920, "y": 1080}},
+    "keys": {"type": "keys", "data": ["ctrl_l", "right"]},
+    "text": {"type": "text", "data": "Hello"},
+}
+
+
+def time_loop(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return time.perf_counter() - start
+
+
+def bench_codec(codec, payload, iterations):
+    encoded = codec.encode(payload)
+    assert codec.decode(encoded) == payload, f"{codec.name} does not round trip {payload}"
+    encode_seconds = time_loop(codec.encode, payload, iterations)
+    decode_seconds = time_loop(codec.decode, encoded, iterations)
+    return {
+        "codec": codec.name,
+        "bytes": len(encoded),
+        "encode_per_sec": iterations / encode_seconds,
+        "decode_per_sec": iterations / decode_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the payload codecs")
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--json", action="store_true", help="print machine readable results")
+    args = parser.parse_args()
+
+    results = {}
+    for name, payload in SAMPLE_PAYLOADS.items():
+        results[name] = [bench_codec(codec, payload, args.iterations) for codec in (JSON_CODEC, BINARY_CODEC)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'payload':<16}{'codec':<8}{'bytes':>7}{'encode/s':>14}{'decode/s':>14}")
+    for name, rows in results.items():
+        for row in rows:
+            print(f"{name:<16}{row['codec']:<8}{row['bytes']:>7}"
+                  f"{row['encode_per_sec']:>14,.0f}{row['decode_per_sec']:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+
+"""
+End to end latency benchmark: key press on the master until the injection on the slave.
+
+socket_server.Server and socket_client.Client run in this process over loopback.
+pynput is replaced by a synthetic key/mouse event source and pyautogui by a
+recording injector that timestamps every call, both with perf_counter_ns so the
+two ends share one clock. Every scenario reports p50/p95/p99 latency and
+throughput as JSON so runs can be diffed.
+
+Usage:
+    python bench_latency.py [--iterations 500] [--output results.json]
+"""
+
+BENCH_MACROS = {
+    "f9": ["KEYS:f9"],
+    "ctrl_l+alt_l+r": ["KEYS:right"],
+    "ctrl_l+alt_l+t": ["TEXT:Hello world"],
+}
+
+SCENARIOS = {
+    "single_key": (["f9"], "hotkey"),
+    "chord": (["ctrl_l", "alt_l", "r"], "hotkey"),
+    "text_macro": (["ctrl_l", "alt_l", "t"], "write"),
+}
+
+
+class RecordingInjector:
+    """Stands in for pyautogui, records (perf_counter_ns, call, args) for every injection"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.calls = []
+
+    def record(self, name, args):
+        now = time.perf_counter_ns()
+        with self.condition:
+            self.calls.append((now, name, args))
+            self.condition.notify_all()
+
+    def wait_for(self, count, timeout=5.0):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.calls) >= count, timeout)
+
+    def as_module(self):
+        module = types.ModuleType("pyautogui")
+        module.write = lambda text, *args, **kwargs: self.record("write", (text,))
+        module.hotkey = lambda *keys, **kwargs: self.record("hotkey", keys)
+        module.moveTo = lambda x, y, *args, **kwargs: self.record("moveTo", (x, y))
+        module.move = lambda dx, dy, *args, **kwargs: self.record("move", (dx, dy))
+        module.keyDown = lambda key, *args, **kwargs: self.record("keyDown", (key,))
+        module.keyUp = lambda key, *args, **kwargs: self.record("keyUp", (key,))
+        return module
+
+
+class SyntheticListener:
+    """Stands in for pynput listeners, the benchmark calls the callbacks itself"""
+
+    def __init__(self, **callbacks):
+        self.callbacks = callbacks
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class SyntheticKey:
+    def __init__(self, name):
+        self.char = name
+
+
+def install_stand_ins(injector):
+    pynput = types.ModuleType("pynput")
+    pynput.keyboard = types.SimpleNamespace(Listener=SyntheticListener)
+    pynput.mouse = types.SimpleNamespace(Listener=SyntheticListener)
+    sys.modules["pynput"] = pynput
+    sys.modules["pynput.keyboard"] = pynput.keyboard
+    sys.modules["pynput.mouse"] = pynput.mouse
+    sys.modules["pyautogui"] = injector.as_module()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize(latencies_ns, elapsed_ns):
+    ordered = sorted(latencies_ns)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] / 1000
+
+    return {
+        "count": len(ordered),
+        "p50_us": percentile(50),
+        "p95_us": percentile(95),
+        "p99_us": percentile(99),
+        "mean_us": sum(ordered) / len(ordered) / 1000,
+        "max_us": ordered[-1] / 1000,
+        "throughput_per_sec": len(ordered) / (elapsed_ns / 1e9) if elapsed_ns else 0.0,
+    }
+
+
+def run_key_scenario(client, injector, keys, expected_call, iterations):
+    latencies = []
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        count = len(injector.calls)
+        for key in keys:
+            pressed_at = time.perf_counter_ns()
+            client.on_key_press(SyntheticKey(key))
+        if not injector.wait_for(count + 1):
+            raise RuntimeError(f"No injection for {'+'.join(keys)} within the timeout")
+        for key in reversed(keys):
+            client.on_key_release(SyntheticKey(key))
+        injected_at, name, _ = injector.calls[count]
+        if name != expected_call:
+            raise RuntimeError(f"Expected a {expected_call} injection, got {name}")
+        latencies.append(injected_at - pressed_at)
+    return summarize(latencies, time.perf_counter_ns() - start)
+
+
+def run_mouse_scenario(client, injector, duration, event_rate):
+    """Feeds one pixel motion events at event_rate, latency is measured from the oldest motion in each flush"""
+    motion_times = []
+    count = len(injector.calls)
+    interval_ns = int(1e9 / event_rate)
+    start = time.perf_counter_ns()
+    next_event = start
+    x = 0
+    while time.perf_counter_ns() - start < duration * 1e9:
+        now = time.perf_counter_ns()
+        if now >= next_event:
+            motion_times.append(now)
+            client.mouse_accumulator.on_move(x, 0)
+            x += 1
+            next_event += interval_ns
+    elapsed = time.perf_counter_ns() - start
+    # The first on_move only sets the start position, every later one moves one pixel
+    expected_pixels = len(motion_times) - 1
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        moved = sum(args[0] for _, name, args in injector.calls[count:] if name == "move")
+        if moved >= expected_pixels:
+            break
+        time.sleep(0.01)
+
+    latencies = []
+    delivered = 0
+    for injected_at, name, args in injector.calls[count:]:
+        if name != "move" or delivered + 1 >= len(motion_times):
+            continue
+        # motion_times[delivered + 1] is the oldest pixel this move carries
+        latencies.append(injected_at - motion_times[delivered + 1])
+        delivered += args[0]
+    result = summarize(latencies, elapsed)
+    result["motion_events"] = len(motion_times)
+    result["pixels_delivered"] = delivered
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure keypress to injection latency over loopback")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--mouse-seconds", type=float, default=2.0)
+    parser.add_argument("--mouse-event-rate", type=int, default=1000, help="synthetic motion events per second")
+    parser.add_argument("--mouse-tick-rate", type=int, default=120)
+    parser.add_argument("--datagrams", action="store_true", help="send mouse moves over the UDP lane")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    injector = RecordingInjector()
+    install_stand_ins(injector)
+    # constants.db and logging_config.yaml are created in the working directory, keep them out of the repo
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="bench_latency_"))
+
+    from custom_logger import CustomLogger
+    from macro_manager import MacroManager
+    from socket_client import Client
+    from socket_server import Server
+
+    # Load the logging config now, otherwise it would reset the level on the first record
+    CustomLogger().setup_logging()
+    logging.getLogger().setLevel(args.log_level)
+    MacroManager.MACROS = dict(BENCH_MACROS)
+    MacroManager.version += 1
+
+    port = free_port()
+    server = Server("127.0.0.1", port, None, datagrams=args.datagrams)
+    threading.Thread(target=server.start, name="BenchServer", daemon=True).start()
+    client = Client("127.0.0.1", port, None, stream_mouse=True, mouse_tick_rate=args.mouse_tick_rate,
+                    datagrams=args.datagrams)
+    client.matcher.cooldown = 0
+    deadline = time.monotonic() + 5
+    while server.server_socket is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    threading.Thread(target=client.start_client_services, name="BenchClient", daemon=True).start()
+    if not client.ready.wait(10):
+        raise RuntimeError("Client did not connect to the benchmark server")
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "codec": client.codec.name,
+            "iterations": args.iterations,
+            "mouse_tick_rate": args.mouse_tick_rate,
+            "datagrams": client.datagram_sender is not None,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scenarios": {},
+    }
+    for name, (keys, expected_call) in SCENARIOS.items():
+        results["scenarios"][name] = run_key_scenario(client, injector, keys, expected_call, args.iterations)
+    results["scenarios"]["mouse_stream"] = run_mouse_scenario(client, injector, args.mouse_seconds,
+                                                              args.mouse_event_rate)
+    client.close()
+
+    output = json.dumps(results, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,10 @@
 # constants_manager.py
-from sqlalchemy import create_engine, Column, String
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import json
+import os
+import threading
 
 from custom_logger import CustomLogger
 
-Base = declarative_base()
-
 """
 How to use:
 
@@ -38,19 +35,21 @@ constants_manager.set('LIST_CONSTANT', [1, 2, 3, 4])
 list_value = constants_manager.get('LIST_CONSTANT')
 print(f"LIST_CONSTANT: {list_value}")  # Should print: LIST_CONSTANT: [1, 2, 3, 4]
 
+# Get told when a constant changes, through set() here or refresh() after another process changed the DB
+constants_manager.subscribe('BUFFER_SIZE', lambda name, value: print(f"{name} is now {value}"))
 
-"""
-
+Reads are served from a JSON snapshot next to the SQLite file (constants.db -> constants.db.json) when the
+snapshot was written for the DB as it is on disk, so a normal start never imports SQLAlchemy. The DB stays the
+source of truth: the snapshot is rewritten after every load from the DB and every set().
 
-class Constants(Base):
-    __tablename__ = 'constants'
-    name = Column(String(50), primary_key=True)
-    value = Column(String(500))
+"""
 
 
 class ConstantsManager:
     _instance = None  # Singleton instance
     _is_initialized = False  # Additional flag to handle initialization
+    _load_lock = threading.Lock()
+    _db_lock = threading.Lock()
 
     DEFAULT_CONSTANTS = {
         'BUFFER_SIZE': 4096,
@@ -59,21 +58,26 @@ class ConstantsManager:
         'SHARED_SECRET': 'ThisIsATestSecretPassword',
         'HOST': '10.0.0.112',
         'PORT': 65432,
-        'DB_NAME': 'macros.db'
+        'DB_NAME': 'macros.db',
+        'MOUSE_TICK_RATE': 120
     }
 
+    SNAPSHOT_SUFFIX = '.json'
+
     def __new__(cls, database_url=None):
         if not cls._instance:
             cls._instance = super(ConstantsManager, cls).__new__(cls)
             # Initialize any attributes you want to set once
             cls._instance.init_once()
-            cls._instance.logger.debug("This is the first creation of this instance")
             cls._instance._cache = {}
-            if database_url:
-                cls._instance.engine = create_engine(database_url)
-                Base.metadata.create_all(cls._instance.engine)
-                cls._instance.Session = sessionmaker(bind=cls._instance.engine)
-                cls._instance._load_constants_into_cache()
+            cls._instance._loaded = False
+            cls._instance._subscribers = {}
+            cls._instance.engine = None
+            # Constants are loaded on the first get/set, not at import time
+            cls._instance.database_url = None
+        if database_url and cls._instance.database_url is None:
+            cls._instance.database_url = database_url
+            cls._instance.db_path = sqlite_path(database_url)
         return cls._instance
 
     def init_once(self):
@@ -81,43 +85,149 @@ class ConstantsManager:
         self.logger = CustomLogger().get_logger("SpecialClassLogger")
         self.some_attribute = "initialized"
 
+    def _ensure_loaded(self):
+        if self._loaded or not self.database_url:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            snapshot = self._read_snapshot()
+            if snapshot is not None:
+                self.logger.debug(f"Loaded {len(snapshot)} constants from the snapshot")
+                self._cache = snapshot
+            else:
+                self._open_db()
+                self._load_constants_into_cache()
+                self._write_snapshot()
+            self._loaded = True
+
+    def _open_db(self):
+        if self.engine is not None:
+            return
+        with self._db_lock:
+            if self.engine is None:
+                # SQLAlchemy is only imported here, when the snapshot can't be used or something is written
+                from sqlalchemy import create_engine
+                from sqlalchemy.orm import sessionmaker
+                from constants_model import Base, Constants
+
+                engine = create_engine(self.database_url)
+                Base.metadata.create_all(engine)
+                self.Session = sessionmaker(bind=engine)
+                self.model = Constants
+                self.engine = engine
+
+    def _db_signature(self):
+        try:
+            stat = os.stat(self.db_path)
+        except (OSError, TypeError):
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _read_snapshot(self):
+        """Constants from the snapshot file, None if there is none or it was not written for the DB on disk"""
+        signature = self._db_signature()
+        if signature is None:
+            return None
+        try:
+            with open(self.db_path + self.SNAPSHOT_SUFFIX, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        constants = snapshot.get('constants')
+        if snapshot.get('db') != signature or not isinstance(constants, dict):
+            self.logger.debug("Constants snapshot is stale, loading from the DB")
+            return None
+        if any(name not in constants for name in self.DEFAULT_CONSTANTS):
+            # A new default has to be written to the DB first
+            return None
+        return constants
+
+    def _write_snapshot(self):
+        signature = self._db_signature()
+        if signature is None:
+            return
+        path = self.db_path + self.SNAPSHOT_SUFFIX
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'db': signature, 'constants': self._cache}, f)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            self.logger.warning(f"Could not write the constants snapshot {path}: {e}")
+
+    def _read_db(self):
+        """Every constant in the DB, defaults that are missing get added to it"""
+        session = self.Session()
+
+        # Fetch existing constants from the DB
+        self.logger.debug("Fetching constants from DB")
+        constants_from_db = session.query(self.model).all()
+        existing_constants = {const.name: json.loads(const.value) for const in constants_from_db}
+
+        # Set defaults for any constants not in the DB
+        self.logger.debug("Set defaults for any constants not in the DB")
+        for name, value in self.DEFAULT_CONSTANTS.items():
+            if name not in existing_constants:
+                self.logger.debug(f"{name} was not in DB, adding it to DB now")
+                serialized_value = json.dumps(value)
+                const = self.model(name=name, value=serialized_value)
+                session.add(const)
+                existing_constants[name] = value
+
+        session.commit()
+        session.close()
+        return existing_constants
+
     def _load_constants_into_cache(self):
         if not self._is_initialized:
             self.logger.debug("First time being initialized")
-            session = self.Session()
-
-            # Fetch existing constants from the DB
-            self.logger.debug("Fetching constants from DB")
-            constants_from_db = session.query(Constants).all()
-            existing_constants = {const.name: json.loads(const.value) for const in constants_from_db}
-
-            # Set defaults for any constants not in the DB
-            self.logger.debug("Set defaults for any constants not in the DB")
-            for name, value in self.DEFAULT_CONSTANTS.items():
-                if name not in existing_constants:
-                    self.logger.debug(f"{name} was not in DB, adding it to DB now")
-                    serialized_value = json.dumps(value)
-                    const = Constants(name=name, value=serialized_value)
-                    session.add(const)
-                    existing_constants[name] = value
+            existing_constants = self._read_db()
 
             # Update the cache
             self.logger.debug("Updating constants cache with all existing constants (DB and default values)")
             self._cache = existing_constants
-
-            session.commit()
-            session.close()
             self._is_initialized = True
 
+    def refresh(self):
+        """Reload every constant from the DB and notify subscribers about the ones that changed"""
+        self._ensure_loaded()
+        self._open_db()
+        constants = self._read_db()
+        previous, self._cache = self._cache, constants
+        self._write_snapshot()
+        for name, value in constants.items():
+            if previous.get(name) != value:
+                self._notify(name, value)
+
+    def subscribe(self, name, callback):
+        """Call callback(name, value) whenever the constant changes, returns callback so it can be unsubscribed"""
+        self._subscribers.setdefault(name, []).append(callback)
+        return callback
+
+    def unsubscribe(self, name, callback):
+        callbacks = self._subscribers.get(name, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def _notify(self, name, value):
+        for callback in list(self._subscribers.get(name, [])):
+            try:
+                callback(name, value)
+            except Exception as e:
+                self.logger.error(f"Subscriber {callback} of {name} failed: {e}")
+
     def get(self, name):
+        self._ensure_loaded()
         cached_value = self._cache.get(name)
         if cached_value is not None:
             return cached_value
 
         # If the value wasn't in cache (for some reason), fetch from the database and deserialize
         self.logger.info(f"{name} not found in cache, searching DB for it")
+        self._open_db()
         session = self.Session()
-        const = session.query(Constants).filter_by(name=name).first()
+        const = session.query(self.model).filter_by(name=name).first()
         session.close()
         if const:
             deserialized_value = json.loads(const.value)
@@ -127,16 +237,30 @@ class ConstantsManager:
         return None  # If the constant wasn't found
 
     def set(self, name, value):
+        self._ensure_loaded()
+        self._open_db()
         self.logger.info(f"Adding {name}, {value} to constants")
+        previous = self._cache.get(name)
         session = self.Session()
         serialized_value = json.dumps(value)  # Convert value to its JSON string representation
-        const = session.query(Constants).filter_by(name=name).first()
+        const = session.query(self.model).filter_by(name=name).first()
         if not const:
             self.logger.info(f"{name} did not exist, adding now")
-            const = Constants(name=name)
+            const = self.model(name=name)
             session.add(const)
         const.value = serialized_value
         self._cache[name] = value  # Cache the original type
         self.logger.info(f"{name} cached and added to DB with val: {value}")
         session.commit()
         session.close()
+        self._write_snapshot()
+        if previous != value:
+            self._notify(name, value)
+
+
+def sqlite_path(database_url):
+    """File behind a sqlite:/// URL, None for anything else (no snapshot is kept for those)"""
+    prefix = "sqlite:///"
+    if not database_url.startswith(prefix) or database_url[len(prefix):] in ("", ":memory:"):
+        return None
+    return database_url[len(prefix):]
@@ -0,0 +1,16 @@
+# constants_model.py
+from sqlalchemy import Column, String
+from sqlalchemy.ext.declarative import declarative_base
+
+"""
+ORM model of the constants table. Kept apart from constants_manager so SQLAlchemy is only imported
+once the constants DB is actually opened.
+"""
+
+Base = declarative_base()
+
+
+class Constants(Base):
+    __tablename__ = 'constants'
+    name = Column(String(50), primary_key=True)
+    value = Column(String(500))
@@ -1,8 +1,12 @@
 # custom_logger.py
 
+import atexit
 import logging
 import logging.config
-import yaml
+import logging.handlers
+import queue
+import threading
+import time
 import os
 
 """
@@ -12,6 +16,96 @@ if using it in a class -> {CLASSBANE}ClassLogger
 """
 
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() renders the message on the calling thread, this one only renders a traceback (which
+    has to happen while the exception is still around) and hands the record over as is. Arguments are
+    formatted later, so callers must not mutate objects they passed as log arguments.
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class BootstrapHandler(logging.Handler):
+    """
+    Root handler installed until the logging config has been read.
+
+    CustomLogger() only installs this one, so importing a module that grabs a logger never touches the
+    config file. The first record that reaches it loads the config, which replaces this handler, and is
+    then passed on to the configured handlers.
+    """
+
+    def handle(self, record):
+        CustomLogger().setup_logging()
+        if record.levelno < logging.getLogger(record.name).getEffectiveLevel():
+            return False
+        for handler in logging.getLogger().handlers:
+            if handler is not self and record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+    def emit(self, record):
+        pass
+
+
+class SampledLogger:
+    """
+    Wrapper for per event messages on the hot paths.
+
+    At most `rate` records per second (with bursts of up to `burst`) are passed on, the rest are only
+    counted and the count is added to the next record that makes it through. Disabled levels cost one
+    isEnabledFor() call, use %-style arguments so nothing is formatted for records that are dropped.
+    """
+
+    def __init__(self, logger, rate=10.0, burst=None):
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def log(self, level, msg, *args):
+        self._log(level, msg, args)
+
+    def debug(self, msg, *args):
+        self._log(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self._log(logging.INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self._log(logging.WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self._log(logging.ERROR, msg, args)
+
+    def _log(self, level, msg, args):
+        if not self.logger.isEnabledFor(level):
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            msg = f"{msg} (%d similar messages suppressed)"
+            args = args + (suppressed,)
+        # stacklevel points the record at whoever called debug/info/warning/log
+        self.logger.log(level, msg, *args, stacklevel=3)
+
+
 class CustomLogger:
     _instance = None  # Singleton instance
 
@@ -40,14 +134,41 @@ class CustomLogger:
     }
 
     CONFIG_PATH = 'logging_config.yaml'
+    # Move the configured root handlers behind a queue so logging calls never wait on I/O
+    QUEUED_HANDLERS = True
+    # Records allowed through per second for the sampled hot path loggers
+    SAMPLE_RATE = 10
+
+    _setup_lock = threading.RLock()
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(CustomLogger, cls).__new__(cls)
-            cls._instance.setup_logging()  # This initializes logging configuration
+            cls._instance.configured = False
+            cls._instance.listener = None
+            cls._instance.install_bootstrap_handler()  # The real configuration is loaded on the first record
         return cls._instance
 
+    def install_bootstrap_handler(self):
+        root = logging.getLogger()
+        if root.handlers:
+            # Somebody configured logging already, leave it alone
+            self.configured = True
+            return
+        root.addHandler(BootstrapHandler())
+        # Until the config says otherwise every record has to reach the bootstrap handler
+        root.setLevel(logging.DEBUG)
+
     def setup_logging(self):
+        with self._setup_lock:
+            if not self.configured:
+                # Set first so a record logged while loading goes straight to whatever handlers exist
+                self.configured = True
+                self._load_config()
+
+    def _load_config(self):
+        import yaml
+
         if os.path.exists(self.CONFIG_PATH):
             with open(self.CONFIG_PATH, 'r') as f:
                 config = yaml.safe_load(f.read())
@@ -56,6 +177,33 @@ class CustomLogger:
             with open(self.CONFIG_PATH, 'w') as f:
                 yaml.dump(self.DEFAULT_CONFIG, f)
             logging.config.dictConfig(self.DEFAULT_CONFIG)
+        for handler in list(logging.getLogger().handlers):
+            if isinstance(handler, BootstrapHandler):
+                logging.getLogger().removeHandler(handler)
+        if self.QUEUED_HANDLERS:
+            self.start_queue_listener()
+
+    def start_queue_listener(self):
+        root = logging.getLogger()
+        handlers = [handler for handler in root.handlers if not isinstance(handler, logging.handlers.QueueHandler)]
+        if not handlers:
+            return
+        log_queue = queue.SimpleQueue()
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(DeferredQueueHandler(log_queue))
+        self.listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        # Flush whatever is still queued when the interpreter exits
+        atexit.register(self.stop_queue_listener)
+
+    def stop_queue_listener(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
 
     def get_logger(self, logger_name=None):
         return logging.getLogger(logger_name)
+
+    def get_sampled_logger(self, logger_name=None, rate=None):
+        return SampledLogger(logging.getLogger(logger_name), rate or self.SAMPLE_RATE)
@@ -0,0 +1,132 @@
+import hashlib
+import hmac
+import itertools
+import socket
+import struct
+import threading
+
+from custom_logger import CustomLogger
+from input_injector import MOUSE_TYPES
+
+"""
+Optional UDP lane for mouse movement next to the TCP connection of Server and Client.
+
+A cursor update is only worth something while it is fresh, so unlike keys and text it should not wait
+behind a lost TCP segment. With the lane enabled the server also binds a UDP socket on its port and
+announces it in the hello reply. A client with a session then sends mouse_move/mouse_move_rel payloads as
+
+    [8 byte session id][8 byte sequence][payload encoded with the session codec][16 byte MAC]
+
+The MAC is a keyed blake2b over everything before it. Its key is derived from the session token that only
+went over the authenticated TCP connection. Datagrams at or below the newest sequence the server has seen
+are stale and dropped, lost ones are simply gone. A lost relative move loses its pixels, the cursor does
+not drift back. Everything else keeps going over TCP.
+"""
+
+module_logger = CustomLogger().get_logger("DatagramLaneModuleLogger")
+
+HEADER = struct.Struct("!8sQ")
+MAC_SIZE = 16
+# Fits in one Ethernet frame, mouse payloads are a few dozen bytes
+MAX_DATAGRAM = 1472
+
+
+def datagram_key(token):
+    # Separate key from the resume proof, both are derived from the same token
+    return hashlib.blake2b(token.encode(), digest_size=32, person=b"mouse-datagram").digest()
+
+
+def sign(key, data):
+    return hashlib.blake2b(data, key=key, digest_size=MAC_SIZE).digest()
+
+
+def encode_datagram(session_id, sequence, key, payload):
+    data = HEADER.pack(bytes.fromhex(session_id), sequence) + payload
+    return data + sign(key, data)
+
+
+class DatagramSender:
+    """Client end, sends mouse payloads of one session to the server"""
+
+    def __init__(self, address, session_id, token, codec):
+        self.address = address
+        self.session_id = session_id
+        self.key = datagram_key(token)
+        self.codec = codec
+        # next() on a count is atomic, the mouse ticker and the macro loop may both send
+        self.sequence = itertools.count(1)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(address)
+
+    def send(self, payload):
+        """Returns False if the datagram could not be sent, the caller then falls back to TCP"""
+        try:
+            self.sock.send(encode_datagram(self.session_id, next(self.sequence), self.key, self.codec.encode(payload)))
+        except OSError as e:
+            module_logger.warning(f"Datagram to {self.address} failed: {e}")
+            return False
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+class DatagramReceiver:
+    """Server end, verifies datagrams against the session registry and hands fresh mouse payloads to handle"""
+
+    def __init__(self, host, port, session_registry, handle, stats):
+        self.logger = CustomLogger().get_logger("DatagramReceiverClassLogger")
+        self.event_logger = CustomLogger().get_sampled_logger("DatagramReceiverClassLogger")
+        self.session_registry = session_registry
+        self.handle = handle
+        self.stats = stats
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="DatagramLane", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Datagram lane listening on {self.sock.getsockname()}")
+
+    def close(self):
+        self.sock.close()
+
+    def run(self):
+        while True:
+            try:
+                packet, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                break
+            try:
+                self.process_datagram(packet, addr)
+            except Exception as e:
+                self.stats.increment("datagram_errors")
+                self.event_logger.error("Bad datagram from %s: %s", addr, e)
+        self.logger.info("Datagram lane stopped")
+
+    def process_datagram(self, packet, addr):
+        if len(packet) < HEADER.size + MAC_SIZE:
+            self.stats.increment("datagram_errors")
+            return
+        session_id, sequence = HEADER.unpack_from(packet)
+        session = self.session_registry.get(session_id.hex())
+        if session is None:
+            self.stats.increment("datagram_unknown_session")
+            return
+        data, mac = packet[:-MAC_SIZE], packet[-MAC_SIZE:]
+        if not hmac.compare_digest(mac, sign(session.datagram_key, data)):
+            self.stats.increment("datagram_bad_mac")
+            self.event_logger.warning("Datagram with a wrong MAC from %s", addr)
+            return
+        if sequence <= session.last_datagram:
+            self.stats.increment("datagram_stale")
+            return
+        session.last_datagram = sequence
+        payload = session.codec.decode(data[HEADER.size:])
+        if payload.get("type") not in MOUSE_TYPES:
+            self.stats.increment("datagram_errors")
+            self.event_logger.warning("Datagram from %s carries a %s payload", addr, payload.get("type"))
+            return
+        self.stats.increment("datagrams")
+        self.handle(payload)
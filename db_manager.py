@@ -1,14 +1,22 @@
 import json
 import logging
+import threading
+import uuid
 
-from sqlalchemy import create_engine, Column, String
+from sqlalchemy import create_engine, Column, Integer, String, bindparam, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from custom_logger import CustomLogger
+from macro_sync import table_checksums
 
 Base = declarative_base()
 
+# Keeps IN (...) lists below SQLite's bound parameter limit
+BULK_CHUNK_SIZE = 500
+# How many revisions of the change log are kept for delta sync, older peers get a snapshot
+CHANGE_LOG_RETENTION = 5000
+
 
 class Macro(Base):
     __tablename__ = 'macros'
@@ -16,15 +24,58 @@ class Macro(Base):
     actions = Column(String(500))
 
 
+class MacroChange(Base):
+    __tablename__ = 'macro_changes'
+    # Revisions must never be reused, even after the log is pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+    revision = Column(Integer, primary_key=True, autoincrement=True)
+    operation = Column(String(10))
+    hotkey = Column(String(50))
+    actions = Column(String(500))
+    old_hotkey = Column(String(50))
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    name = Column(String(100), primary_key=True)
+    value = Column(String(100))
+
+
 class MacroDBManager:
     def __init__(self, database_url):
         self.logger = CustomLogger().get_logger("MacroDBManagerClassLogger")
-        self.engine = create_engine(database_url)
-        Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
+        # The engine is created on first use so building the manager costs nothing at startup
+        self.database_url = database_url
+        self._engine = None
+        self._session_factory = None
+        self._engine_lock = threading.Lock()
         # in memory transactions
         self.transactions = []
         self.observers = []
+        # Write-through cache of the decoded macro table (hotkey -> actions), loaded on first read
+        self._cache = None
+        self._cache_lock = threading.RLock()
+
+    def _open(self):
+        with self._engine_lock:
+            if self._engine is None:
+                engine = create_engine(self.database_url)
+                Base.metadata.create_all(engine)
+                self._session_factory = sessionmaker(bind=engine)
+                self._engine = engine
+                self.logger.info(f"Opened macro DB at {self.database_url}")
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._open()
+        return self._engine
+
+    @property
+    def Session(self):
+        if self._engine is None:
+            self._open()
+        return self._session_factory
 
     def register_observers(self, observer):
         self.observers.append(observer)
@@ -38,26 +89,46 @@ class MacroDBManager:
             self.logger.info(f"Notifying Observer: {observer} about transaction: {transaction}")
             observer.update(transaction)
 
-    def _log_transaction(self, operation, hotkey, actions=None, old_hotkey=None):
+    def notify_observers_batch(self, transactions):
+        self.logger.info(f"Notifying observers about a batch of {len(transactions)} transactions")
+        for observer in self.observers:
+            observer.update_batch(transactions)
+
+    def _log_transaction(self, operation, hotkey, actions=None, old_hotkey=None, revision=None):
         transaction = {
             'operation': operation,
             'hotkey': hotkey,
             'actions': actions,
-            'old_hotkey':old_hotkey
+            'old_hotkey':old_hotkey,
+            'revision': revision
         }
         self.transactions.append(transaction)
 
+    def _record_change(self, session, operation, hotkey, actions=None, old_hotkey=None):
+        """Adds the change to the revision log inside the caller's session, returns its revision"""
+        change = MacroChange(operation=operation, hotkey=hotkey, old_hotkey=old_hotkey,
+                             actions=json.dumps(actions) if actions is not None else None)
+        session.add(change)
+        session.flush()
+        if change.revision % 500 == 0:
+            session.query(MacroChange).filter(MacroChange.revision <= change.revision - CHANGE_LOG_RETENTION) \
+                .delete(synchronize_session=False)
+        return change.revision
+
     def add_macro(self, hotkey, actions):
         self.logger.info(f"Adding: {hotkey} with actions: {actions}")
-        session = self.Session()
-        if not session.query(Macro).filter_by(hotkey=hotkey).first():
+        if hotkey not in self._macro_cache():
+            session = self.Session()
             serialized_actions = json.dumps(actions)
             new_macro = Macro(hotkey=hotkey, actions=serialized_actions)
             self.logger.info(f"Adding new macro:{new_macro}")
             session.add(new_macro)
+            revision = self._record_change(session, "add", hotkey, actions)
             session.commit()
             session.close()
-            self._log_transaction("add", hotkey, actions)
+            with self._cache_lock:
+                self._macro_cache()[hotkey] = actions
+            self._log_transaction("add", hotkey, actions, revision=revision)
             self.notify_observers(self.transactions[-1])
         else:
             self.logger.warning(f"Hotkey: {hotkey} already in DB, skipping add")
@@ -67,9 +138,12 @@ class MacroDBManager:
         macro = session.query(Macro).filter_by(hotkey=hotkey).first()
         if macro:
             session.query(Macro).filter_by(hotkey=hotkey).delete()
+        revision = self._record_change(session, "delete", hotkey)
         session.commit()
         session.close()
-        self._log_transaction("delete", hotkey)
+        with self._cache_lock:
+            self._macro_cache().pop(hotkey, None)
+        self._log_transaction("delete", hotkey, revision=revision)
         self.notify_observers(self.transactions[-1])
 
     def edit_macro(self, old_hotkey, new_hotkey, new_actions):
@@ -88,30 +162,123 @@ class MacroDBManager:
             if macro:
                 self.logger.info(f"macro esists, updating actions to: {new_actions}")
                 macro.actions = json.dumps(new_actions)
+        revision = self._record_change(session, "edit", new_hotkey, new_actions, old_hotkey)
         session.commit()
         session.close()
-        self._log_transaction("edit", new_hotkey, new_actions, old_hotkey)
+        if macro:
+            with self._cache_lock:
+                cache = self._macro_cache()
+                if old_hotkey:
+                    cache.pop(old_hotkey, None)
+                cache[new_hotkey] = new_actions
+        self._log_transaction("edit", new_hotkey, new_actions, old_hotkey, revision=revision)
         self.notify_observers(self.transactions[-1])
 
     def get_all_macros(self):
+        with self._cache_lock:
+            return [{'hotkey': hotkey, 'actions': list(actions)} for hotkey, actions in self._macro_cache().items()]
+
+    def get_macro(self, hotkey):
+        actions = self._macro_cache().get(hotkey)
+        if actions is None:
+            return None
+        return Macro(hotkey=hotkey, actions=list(actions))
+
+    def _macro_cache(self):
+        cache = self._cache
+        if cache is None:
+            with self._cache_lock:
+                if self._cache is None:
+                    self._cache = self._read_macro_table()
+                    self.logger.info(f"Macro cache warmed up with {len(self._cache)} macros")
+                cache = self._cache
+        return cache
+
+    def _read_macro_table(self):
         session = self.Session()
         macros = session.query(Macro).all()
-        result = []
-        for macro in macros:
-            result.append({
-                'hotkey': macro.hotkey,
-                'actions': json.loads(macro.actions)
-            })
+        table = {macro.hotkey: json.loads(macro.actions) for macro in macros}
+        session.close()
+        return table
+
+    def invalidate_cache(self):
+        """Drop the cached table, the next read loads it from the DB again"""
+        with self._cache_lock:
+            self.logger.info("Invalidating macro cache")
+            self._cache = None
+
+    def verify_cache(self):
+        """Compare the cache with the DB, reloads it and returns False if they drifted apart"""
+        with self._cache_lock:
+            table = self._read_macro_table()
+            if self._cache is None or self._cache == table:
+                self._cache = table
+                return True
+            self.logger.warning("Macro cache was out of sync with the DB, reloading it")
+            self._cache = table
+            return False
+
+    def table_checksums(self):
+        with self._cache_lock:
+            return table_checksums(self._macro_cache())
+
+    def latest_revision(self):
+        session = self.Session()
+        revision = session.query(func.max(MacroChange.revision)).scalar()
+        session.close()
+        return revision or 0
+
+    def oldest_revision(self):
+        session = self.Session()
+        revision = session.query(func.min(MacroChange.revision)).scalar()
+        session.close()
+        return revision or 0
+
+    def get_changes_since(self, revision):
+        session = self.Session()
+        changes = session.query(MacroChange).filter(MacroChange.revision > revision) \
+            .order_by(MacroChange.revision).all()
+        result = [{
+            'operation': change.operation,
+            'hotkey': change.hotkey,
+            'actions': json.loads(change.actions) if change.actions is not None else None,
+            'old_hotkey': change.old_hotkey,
+            'revision': change.revision
+        } for change in changes]
         session.close()
         return result
 
-    def get_macro(self, hotkey):
+    def _get_state(self, name):
         session = self.Session()
-        macro = session.query(Macro).filter_by(hotkey=hotkey).first()
-        if macro:
-            macro.actions = json.loads(macro.actions)
+        state = session.query(SyncState).filter_by(name=name).first()
         session.close()
-        return macro
+        return state.value if state else None
+
+    def _set_state(self, name, value):
+        session = self.Session()
+        state = session.query(SyncState).filter_by(name=name).first()
+        if not state:
+            state = SyncState(name=name)
+            session.add(state)
+        state.value = str(value)
+        session.commit()
+        session.close()
+
+    def get_db_id(self):
+        """Random id of this DB, peers use it to remember which revision of it they applied"""
+        db_id = self._get_state('db_id')
+        if db_id is None:
+            db_id = uuid.uuid4().hex
+            self._set_state('db_id', db_id)
+        return db_id
+
+    def get_peer_revision(self, db_id):
+        revision = self._get_state(f"peer_revision:{db_id}")
+        return int(revision) if revision is not None else 0
+
+    def set_peer_revision(self, db_id, revision):
+        self.logger.info(f"Peer {db_id} is now at revision {revision}")
+        self._set_state(f"peer_revision:{db_id}", revision)
 
     def get_all_transactions(self):
         return self.transactions
@@ -121,25 +288,115 @@ class MacroDBManager:
         self.transactions.clear()
 
     def apply_transactions(self, transactions):
-        # session = self.Session()
-        self.logger.info(f"Going to apply the following transactions: {transactions}")
+        """
+        Apply a whole batch of synced transactions in one session and one DB transaction.
+
+        The batch is first replayed against the affected rows in memory, then written with one bulk
+        delete, update and insert. If any item is invalid or the DB write fails nothing is applied.
+        Returns True when the batch was committed.
+        """
+        self.logger.info(f"Going to apply a batch of {len(transactions)} transactions")
+        if not transactions:
+            return True
+        table = Macro.__table__
+        session = self.Session()
+        try:
+            with session.begin():
+                original = self._load_rows(session, self._hotkeys_in(transactions))
+                rows, applied = self._replay_transactions(original, transactions)
+
+                deleted = [hotkey for hotkey in original if hotkey not in rows]
+                updated = [{'b_hotkey': hotkey, 'b_actions': actions} for hotkey, actions in rows.items()
+                           if hotkey in original and original[hotkey] != actions]
+                inserted = [{'hotkey': hotkey, 'actions': actions} for hotkey, actions in rows.items()
+                            if hotkey not in original]
+
+                for start in range(0, len(deleted), BULK_CHUNK_SIZE):
+                    session.execute(table.delete().where(table.c.hotkey.in_(deleted[start:start + BULK_CHUNK_SIZE])))
+                if updated:
+                    session.execute(table.update().where(table.c.hotkey == bindparam('b_hotkey'))
+                                    .values(actions=bindparam('b_actions')), updated)
+                if inserted:
+                    session.execute(table.insert(), inserted)
+                if applied:
+                    session.execute(MacroChange.__table__.insert(), [{
+                        'operation': transaction.get("operation"),
+                        'hotkey': transaction.get("hotkey"),
+                        'actions': json.dumps(transaction.get("actions"))
+                        if transaction.get("actions") is not None else None,
+                        'old_hotkey': transaction.get("old_hotkey"),
+                    } for transaction in applied])
+        except Exception as e:
+            self.logger.error(f"Batch of {len(transactions)} transactions rolled back, nothing applied: {e}")
+            return False
+        finally:
+            session.close()
+
+        with self._cache_lock:
+            if self._cache is not None:
+                for hotkey in deleted:
+                    self._cache.pop(hotkey, None)
+                for hotkey, actions in rows.items():
+                    if original.get(hotkey) != actions:
+                        self._cache[hotkey] = json.loads(actions)
+
+        self.logger.info(f"Batch applied: {len(inserted)} inserted, {len(updated)} updated, {len(deleted)} deleted")
+        if applied:
+            self.notify_observers_batch(applied)
+        return True
+
+    @staticmethod
+    def _hotkeys_in(transactions):
+        hotkeys = set()
+        for transaction in transactions:
+            hotkeys.add(transaction.get("hotkey"))
+            if transaction.get("old_hotkey"):
+                hotkeys.add(transaction.get("old_hotkey"))
+        hotkeys.discard(None)
+        return list(hotkeys)
+
+    @staticmethod
+    def _load_rows(session, hotkeys):
+        table = Macro.__table__
+        rows = {}
+        for start in range(0, len(hotkeys), BULK_CHUNK_SIZE):
+            query = table.select().where(table.c.hotkey.in_(hotkeys[start:start + BULK_CHUNK_SIZE]))
+            for hotkey, actions in session.execute(query):
+                rows[hotkey] = actions
+        return rows
+
+    def _replay_transactions(self, original, transactions):
+        """Replays the batch against the affected rows, returns the resulting rows and the transactions that took effect"""
+        rows = dict(original)
+        applied = []
         for transaction in transactions:
             operation = transaction.get("operation")
             hotkey = transaction.get("hotkey")
             actions = transaction.get("actions")
             old_hotkey = transaction.get("old_hotkey")
-            self.logger.info(f"Operation:{operation}, hotkey:{hotkey}, actions: {actions}, old_hotkey: {old_hotkey}")
+            if not hotkey:
+                raise ValueError(f"Transaction without a hotkey: {transaction}")
 
             if operation == "add":
-                self.logger.info("Add operation requested")
-                self.add_macro(hotkey, actions)
-                self.clear_transactions()
-
+                if hotkey in rows:
+                    self.logger.warning(f"Hotkey: {hotkey} already in DB, skipping add")
+                    continue
+                rows[hotkey] = json.dumps(actions)
             elif operation == "edit":
-                self.logger.info(f"Edit operation requested")
-                self.edit_macro(old_hotkey, hotkey, actions)
-                self.clear_transactions()
-
+                current = old_hotkey or hotkey
+                if current not in rows:
+                    self.logger.warning(f"Hotkey: {current} not in DB, skipping edit")
+                    continue
+                if current != hotkey and hotkey in rows:
+                    raise ValueError(f"Cannot rename {current} to {hotkey}, hotkey already exists")
+                del rows[current]
+                rows[hotkey] = json.dumps(actions)
             elif operation == "delete":
-                self.delete_macro(hotkey)
-                self.clear_transactions()
+                if hotkey not in rows:
+                    self.logger.warning(f"Hotkey: {hotkey} not in DB, skipping delete")
+                    continue
+                del rows[hotkey]
+            else:
+                raise ValueError(f"Unknown operation in transaction: {transaction}")
+            applied.append(transaction)
+        return rows, applied
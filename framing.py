@@ -0,0 +1,259 @@
+import asyncio
+import select
+import socket
+import struct
+import time
+
+from custom_logger import CustomLogger
+
+"""
+Wire framing shared by socket_server and socket_client.
+
+Every message on the TCP stream is sent as a frame:
+
+    [4 byte big endian payload length][payload bytes]
+
+so the receiving side never has to assume that one recv() returns exactly one
+message. A FrameReader keeps a single preallocated buffer per connection, reads
+into it with recv_into and hands back every complete frame found in a read.
+"""
+
+module_logger = CustomLogger().get_logger("FramingModuleLogger")
+
+HEADER = struct.Struct("!I")
+# Prefix of every frame a client sends once it has a resumable session, see session_registry.py
+SEQUENCE = struct.Struct("!Q")
+# Length header and sequence number of a sequenced frame packed in one go
+SEQUENCED_HEADER = struct.Struct("!IQ")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Buffers handed to one sendmsg call, IOV_MAX is 1024 on Linux and macOS
+MAX_IOV = 1024
+# An idle connection is probed after KEEPALIVE_IDLE seconds, then every KEEPALIVE_INTERVAL seconds, and
+# counts as dead after KEEPALIVE_PROBES unanswered probes
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 3
+KEEPALIVE_PROBES = 3
+
+
+class FramingError(Exception):
+    pass
+
+
+def encode_frame(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if len(data) > MAX_FRAME_SIZE:
+        raise FramingError(f"Frame of {len(data)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(len(data)) + data
+
+
+def add_sequence(sequence, data):
+    return SEQUENCE.pack(sequence) + data
+
+
+def split_sequence(frame):
+    """(sequence number, payload) of a frame sent inside a resumable session"""
+    if len(frame) < SEQUENCE.size:
+        raise FramingError(f"Frame of {len(frame)} bytes is too short for a sequence number")
+    (sequence,) = SEQUENCE.unpack_from(frame)
+    return sequence, frame[SEQUENCE.size:]
+
+
+def sequenced_frame(sequence, data):
+    """Header and payload of a sequenced frame as two buffers, for send_frames"""
+    if len(data) > MAX_FRAME_SIZE - SEQUENCE.size:
+        raise FramingError(f"Frame of {len(data)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return SEQUENCED_HEADER.pack(len(data) + SEQUENCE.size, sequence), data
+
+
+def send_frame(sock, data):
+    sock.sendall(encode_frame(data))
+
+
+def enable_keepalive(sock):
+    """
+    Make a peer that vanished without closing the connection (cable pulled, Wi-Fi roam) end the blocked recv
+    with an error within about KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_PROBES seconds. Keepalive only
+    probes an idle connection, where supported TCP_USER_TIMEOUT does the same for unacknowledged sends
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "SIO_KEEPALIVE_VALS") and hasattr(sock, "ioctl"):
+        # Windows, takes milliseconds. asyncio's socket wrappers have no ioctl, they get the options below
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, KEEPALIVE_IDLE * 1000, KEEPALIVE_INTERVAL * 1000))
+    # TCP_KEEPALIVE is macOS's name for TCP_KEEPIDLE
+    idle_option = getattr(socket, "TCP_KEEPIDLE", None) or getattr(socket, "TCP_KEEPALIVE", None)
+    options = [(idle_option, KEEPALIVE_IDLE),
+               (getattr(socket, "TCP_KEEPINTVL", None), KEEPALIVE_INTERVAL),
+               (getattr(socket, "TCP_KEEPCNT", None), KEEPALIVE_PROBES),
+               (getattr(socket, "TCP_USER_TIMEOUT", None),
+                (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_PROBES) * 1000)]
+    for option, value in options:
+        if option is None:
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except OSError as e:
+            # Older Windows builds have the constants but reject some of them
+            module_logger.debug(f"Keepalive option {option} not supported: {e}")
+
+
+def send_frames(sock, buffers):
+    """
+    Write a batch of frame buffers with as few syscalls as possible.
+
+    Uses scatter-gather sendmsg so the buffers are not copied into one, platforms without it (Windows)
+    get a single sendall of the joined buffers.
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = list(buffers)
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + MAX_IOV])
+        # Skip what was written completely, a partially written buffer continues where it stopped
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        if sent:
+            buffers[index] = memoryview(buffers[index])[sent:]
+
+
+async def read_frame_async(stream_reader):
+    """asyncio counterpart of FrameReader.read_frame, returns None once the peer closed the connection"""
+    try:
+        header = await stream_reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            module_logger.warning(f"Connection closed with {len(e.partial)} bytes of a partial frame header")
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FramingError(f"Peer announced a frame of {length} bytes, limit is {MAX_FRAME_SIZE}")
+    try:
+        return await stream_reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        module_logger.warning("Connection closed in the middle of a frame")
+        return None
+
+
+async def send_frame_async(stream_writer, data):
+    stream_writer.write(encode_frame(data))
+    await stream_writer.drain()
+
+
+class FrameReader:
+    def __init__(self, sock, buffer_size=4096, stats=None):
+        self.sock = sock
+        self.stats = stats
+        self._buffer = bytearray(max(buffer_size, HEADER_SIZE))
+        self._view = memoryview(self._buffer)
+        # Unconsumed bytes live in self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # Size the buffer must reach to hold the frame currently being received
+        self._required = 0
+        # Set by resize(), applied by the reading thread before its next recv
+        self._resize_to = None
+
+    def read_frames(self):
+        """Block until at least one frame is complete, returns None once the peer closed the connection"""
+        while True:
+            start = time.perf_counter_ns()
+            frames = self._extract_frames()
+            if frames:
+                if self.stats is not None:
+                    self.stats.record_since("deframe", start)
+                    self.stats.increment("frames", len(frames))
+                return frames
+            self._make_room()
+            received = self.sock.recv_into(self._view[self._end:])
+            if not received:
+                if self._end != self._start:
+                    module_logger.warning(f"Connection closed with {self._end - self._start} bytes of a partial frame")
+                return None
+            self._end += received
+            if self.stats is not None:
+                self.stats.increment("reads")
+                self.stats.increment("bytes_received", received)
+
+    def read_frame(self, timeout=None):
+        """
+        Read exactly one frame, used for the lockstep handshake before the main loop starts. With a timeout in
+        seconds raises TimeoutError when no frame is complete by then, a partial frame stays buffered
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        frame = self._next_frame()
+        while frame is None:
+            self._make_room()
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                # Waits without a socket timeout, that would also apply to a writer thread sending on it
+                if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                    raise TimeoutError(f"No frame within {timeout}s")
+            received = self.sock.recv_into(self._view[self._end:])
+            if not received:
+                return None
+            self._end += received
+            frame = self._next_frame()
+        return frame
+
+    def _next_frame(self):
+        available = self._end - self._start
+        if available < HEADER_SIZE:
+            return None
+        (length,) = HEADER.unpack_from(self._buffer, self._start)
+        if length > MAX_FRAME_SIZE:
+            raise FramingError(f"Peer announced a frame of {length} bytes, limit is {MAX_FRAME_SIZE}")
+        if available < HEADER_SIZE + length:
+            self._required = HEADER_SIZE + length
+            return None
+        self._required = 0
+        body_start = self._start + HEADER_SIZE
+        frame = bytes(self._view[body_start:body_start + length])
+        self._start = body_start + length
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frame
+
+    def _extract_frames(self):
+        frames = []
+        frame = self._next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self._next_frame()
+        return frames
+
+    def resize(self, buffer_size):
+        """Change the buffer size, safe to call from any thread, a frame in flight is never cut short"""
+        self._resize_to = max(buffer_size, HEADER_SIZE)
+
+    def _make_room(self):
+        if self._resize_to is not None:
+            self._reallocate(self._resize_to)
+            self._resize_to = None
+        pending = self._end - self._start
+        if self._start and (pending == 0 or self._end == len(self._buffer)):
+            # Slide the partial frame to the front so the tail of the buffer is free again
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        if self._end == len(self._buffer) or self._required > len(self._buffer):
+            new_size = max(len(self._buffer) * 2, self._required)
+            module_logger.debug(f"Growing frame buffer to {new_size} bytes")
+            self._view.release()
+            self._buffer.extend(bytes(new_size - len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+    def _reallocate(self, size):
+        pending = self._end - self._start
+        size = max(size, pending, self._required)
+        if size == len(self._buffer):
+            return
+        module_logger.info(f"Resizing frame buffer from {len(self._buffer)} to {size} bytes")
+        data = self._buffer[self._start:self._end]
+        self._view.release()
+        self._buffer = bytearray(size)
+        self._buffer[:pending] = data
+        self._view = memoryview(self._buffer)
+        self._start, self._end = 0, pending
@@ -0,0 +1,81 @@
+import time
+
+from custom_logger import CustomLogger
+from key_state import KeyStateTracker
+from macro_manager import MacroManager
+
+NEVER = float("-inf")
+
+
+class HotkeyMatcher:
+    """
+    Matches hotkey chords from key press and release events instead of polling every macro.
+
+    Key state lives in a KeyStateTracker, a chord fires on the press that makes all of its keys down at the
+    same time. Auto repeat presses of a held key never fire. The index maps every key id to the chords that
+    contain it, biggest chord first so ctrl_l+alt_l+r wins over a plain r, and is rebuilt lazily whenever
+    MacroManager.version changes.
+
+    A key's char depends on the modifiers held when the event fires (press a, press shift, release a reports
+    'A'), so callers pass a modifier independent key_code too and a release clears the name its press recorded.
+    """
+
+    def __init__(self, cooldown=0.5, tracker=None):
+        self.logger = CustomLogger().get_logger("HotkeyMatcherClassLogger")
+        self.event_logger = CustomLogger().get_sampled_logger("HotkeyMatcherClassLogger")
+        self.cooldown = cooldown
+        self.tracker = tracker or KeyStateTracker()
+        self.last_fired = {}
+        # key_code -> key name recorded by its press
+        self.pressed_names = {}
+        self.index = {}
+        self.index_version = None
+
+    def rebuild_index(self):
+        version = MacroManager.version
+        index = {}
+        for hotkey in list(MacroManager.get_macros()):
+            chord = tuple(self.tracker.key_id(key) for key in set(hotkey.split('+')))
+            for key_id in chord:
+                index.setdefault(key_id, []).append((hotkey, chord))
+        for candidates in index.values():
+            candidates.sort(key=lambda candidate: len(candidate[1]), reverse=True)
+        self.index = index
+        self.index_version = version
+        self.logger.info(f"Hotkey index rebuilt with {len(index)} keys")
+
+    def on_press(self, key_name, now=None, key_code=None):
+        """Record a key press, returns the hotkey it completes or None"""
+        if self.index_version != MacroManager.version:
+            self.rebuild_index()
+        if now is None:
+            now = time.monotonic()
+        if key_code is not None:
+            key_name = self.pressed_names.setdefault(key_code, key_name)
+        key_id = self.tracker.key_id(key_name)
+        repeat = self.tracker.down[key_id]
+        self.tracker.press(key_name, now)
+        if repeat:
+            return None
+
+        candidates = self.index.get(key_id)
+        if not candidates:
+            return None
+        for hotkey, chord in candidates:
+            if self.tracker.all_down(chord):
+                if now - self.last_fired.get(hotkey, NEVER) < self.cooldown:
+                    continue
+                self.last_fired[hotkey] = now
+                self.event_logger.info("Will execute macro: %s", hotkey)
+                return hotkey
+        return None
+
+    def on_release(self, key_name, now=None, key_code=None):
+        if key_code is not None:
+            key_name = self.pressed_names.pop(key_code, key_name)
+        self.tracker.release(key_name, now)
+
+    def reset(self):
+        """Drop all held keys, used when the listener (re)starts and releases may have been missed"""
+        self.tracker.release_all()
+        self.pressed_names.clear()
@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+
+from custom_logger import CustomLogger
+
+MOUSE_TYPES = ("mouse_move", "mouse_move_rel")
+
+
+class InputInjector:
+    """
+    Injection stage that sits behind Server.process_received_payload.
+
+    Payloads are put on a bounded queue and injected by a dedicated thread.
+    Whatever piled up while the previous injection was running is drained in
+    one go and coalesced first: consecutive relative moves are summed, absolute
+    moves drop the mouse moves they supersede and adjacent text chunks are
+    joined. Key presses are never merged or dropped.
+    """
+
+    def __init__(self, sink, max_queue_size=1024, max_batch=256, stats=None):
+        self.logger = CustomLogger().get_logger("InputInjectorClassLogger")
+        self.event_logger = CustomLogger().get_sampled_logger("InputInjectorClassLogger")
+        self.sink = sink
+        self.perf = stats
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.max_batch = max_batch
+        self.thread = None
+        self.counters = {
+            'submitted': 0,
+            'injected': 0,
+            'batches': 0,
+            'coalesced_rel_moves': 0,
+            'superseded_moves': 0,
+            'joined_text': 0,
+            'errors': 0,
+        }
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, name="InputInjector", daemon=True)
+        self.thread.start()
+        self.logger.info("Input injector started")
+
+    def close(self):
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+
+    def submit(self, payload):
+        """Queue a payload for injection, blocks while the queue is full so the sender gets back pressure"""
+        self.queue.put((payload, time.perf_counter_ns()))
+        self.counters['submitted'] += 1
+
+    def try_submit(self, payload):
+        """Non blocking submit, returns False if the queue is full"""
+        try:
+            self.queue.put_nowait((payload, time.perf_counter_ns()))
+        except queue.Full:
+            return False
+        self.counters['submitted'] += 1
+        return True
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self.counters['batches'] += 1
+            if self.perf is not None:
+                dequeued = time.perf_counter_ns()
+                for _, enqueued in batch:
+                    self.perf.record("queue_wait", dequeued - enqueued)
+            for payload in self.coalesce([payload for payload, _ in batch]):
+                start = time.perf_counter_ns()
+                try:
+                    self.sink(payload)
+                    self.counters['injected'] += 1
+                except Exception as e:
+                    self.counters['errors'] += 1
+                    self.event_logger.error("Error injecting payload %s: %s", payload, e)
+                if self.perf is not None:
+                    self.perf.record_since("inject", start)
+            if stop:
+                break
+        self.logger.info(f"Input injector stopped, stats: {self.stats()}")
+
+    def coalesce(self, batch):
+        out = []
+        for payload in batch:
+            payload_type = payload.get("type")
+            last_type = out[-1].get("type") if out else None
+
+            if payload_type == "mouse_move_rel" and last_type == "mouse_move_rel":
+                data, last_data = payload["data"], out[-1]["data"]
+                out[-1] = {"type": "mouse_move_rel",
+                           "data": {"dx": last_data["dx"] + data["dx"], "dy": last_data["dy"] + data["dy"]}}
+                self.counters['coalesced_rel_moves'] += 1
+            elif payload_type == "mouse_move_rel" and last_type == "mouse_move":
+                # A relative move right after an absolute one just shifts the absolute target
+                data, last_data = payload["data"], out[-1]["data"]
+                out[-1] = {"type": "mouse_move",
+                           "data": {"x": last_data["x"] + data["dx"], "y": last_data["y"] + data["dy"]}}
+                self.counters['coalesced_rel_moves'] += 1
+            elif payload_type == "mouse_move":
+                # Nothing between the previous moves and this one depended on the cursor, so they are superseded
+                while out and out[-1].get("type") in MOUSE_TYPES:
+                    out.pop()
+                    self.counters['superseded_moves'] += 1
+                out.append(payload)
+            elif payload_type == "text" and last_type == "text":
+                out[-1] = {"type": "text", "data": out[-1]["data"] + payload["data"]}
+                self.counters['joined_text'] += 1
+            else:
+                out.append(payload)
+        return out
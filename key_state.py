@@ -0,0 +1,103 @@
+import time
+from array import array
+
+"""
+Tracks which keys are down, fed by the press and release callbacks of the keyboard listener.
+
+Every key name gets a small integer id the first time it is seen. The down flags and press times are
+plain arrays indexed by that id, so checking whether a set of keys is held together is one index per key
+and allocates nothing. The last `capacity` events are kept in a preallocated ring buffer for diagnostics.
+All times come from time.monotonic().
+"""
+
+DEFAULT_CAPACITY = 256
+# Ids handed out before the per key arrays have to grow, more than the keys on any keyboard
+INITIAL_KEYS = 256
+
+
+class KeyStateTracker:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.key_ids = {}
+        self.key_names = []
+        self.down = bytearray(INITIAL_KEYS)
+        self.down_since = array('d', bytes(8 * INITIAL_KEYS))
+        # Ring buffer, slot i % capacity holds event number i
+        self.capacity = capacity
+        self.event_times = array('d', bytes(8 * capacity))
+        self.event_keys = array('i', bytes(4 * capacity))
+        self.event_down = bytearray(capacity)
+        self.events = 0
+
+    def key_id(self, key_name):
+        key_id = self.key_ids.get(key_name)
+        if key_id is None:
+            key_id = self.key_ids[key_name] = len(self.key_names)
+            self.key_names.append(key_name)
+            if key_id >= len(self.down):
+                self.down.extend(bytes(len(self.down)))
+                self.down_since.extend(array('d', bytes(8 * len(self.down_since))))
+        return key_id
+
+    def press(self, key_name, now=None):
+        """Record a press, returns the key id. Auto repeat keeps the time of the original press"""
+        if now is None:
+            now = time.monotonic()
+        key_id = self.key_id(key_name)
+        if not self.down[key_id]:
+            self.down[key_id] = 1
+            self.down_since[key_id] = now
+        self._record(key_id, 1, now)
+        return key_id
+
+    def release(self, key_name, now=None):
+        if now is None:
+            now = time.monotonic()
+        key_id = self.key_id(key_name)
+        self.down[key_id] = 0
+        self._record(key_id, 0, now)
+        return key_id
+
+    def _record(self, key_id, down, now):
+        slot = self.events % self.capacity
+        self.event_times[slot] = now
+        self.event_keys[slot] = key_id
+        self.event_down[slot] = down
+        self.events += 1
+
+    def is_down(self, key_name):
+        key_id = self.key_ids.get(key_name)
+        return key_id is not None and bool(self.down[key_id])
+
+    def all_down(self, key_ids):
+        """True if every key id in key_ids is held right now"""
+        down = self.down
+        for key_id in key_ids:
+            if not down[key_id]:
+                return False
+        return True
+
+    def held_for(self, key_name, now=None):
+        """Seconds the key has been held, 0.0 if it is up"""
+        key_id = self.key_ids.get(key_name)
+        if key_id is None or not self.down[key_id]:
+            return 0.0
+        return (time.monotonic() if now is None else now) - self.down_since[key_id]
+
+    def pressed_keys(self):
+        return [name for key_id, name in enumerate(self.key_names) if self.down[key_id]]
+
+    def release_all(self):
+        """Forget every held key, for when the listener restarts and releases may have been missed"""
+        for key_id in range(len(self.key_names)):
+            self.down[key_id] = 0
+
+    def recent_events(self, count=None):
+        """The last events as (time, key name, is_press), oldest first"""
+        available = min(self.events, self.capacity)
+        count = available if count is None else min(count, available)
+        events = []
+        for number in range(self.events - count, self.events):
+            slot = number % self.capacity
+            events.append((self.event_times[slot], self.key_names[self.event_keys[slot]],
+                           bool(self.event_down[slot])))
+        return events
@@ -0,0 +1,36 @@
+import importlib
+import threading
+
+"""
+Stand-in for modules that are expensive to import or only needed once a service runs.
+
+    pyautogui = LazyModule("pyautogui")
+
+keeps the call sites as they are (pyautogui.write(...)), the real import happens on the first
+attribute access and the module is cached from then on.
+"""
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attribute):
+        # Only called for attributes the proxy itself does not have
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return f"LazyModule({self._name!r}, loaded={self.loaded})"
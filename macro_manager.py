@@ -10,6 +10,8 @@ class MacroManager:
         "ctrl_l+alt_l+.": ["KEYS:ctrl_l+right"],
         "ctrl_l+alt_l+/": ["KEYS:ctrl_l+left"]
     }
+    # Bumped on every change to MACROS so consumers can rebuild derived state lazily
+    version = 0
 
     @staticmethod
     def display_macros():
@@ -23,19 +25,23 @@ class MacroManager:
     @staticmethod
     def add_macro(hotkey, action):
         MacroManager.MACROS[hotkey] = [action]
+        MacroManager.version += 1
 
     @staticmethod
-    def edit_macro(old_hotkey, new_hotkey, new_action):
+    def edit_macro(old_hotkey, new_hotkey, new_actions):
+        # new_actions is the parsed command list, like add_actions takes
         if old_hotkey not in MacroManager.MACROS:
             MacroManager.logger.info("Original key combination not found!")
             return
         del MacroManager.MACROS[old_hotkey]
-        MacroManager.MACROS[new_hotkey] = [new_action]
+        MacroManager.MACROS[new_hotkey] = list(new_actions)
+        MacroManager.version += 1
 
     @staticmethod
     def delete_macro(hotkey):
         if hotkey in MacroManager.MACROS:
             del MacroManager.MACROS[hotkey]
+            MacroManager.version += 1
         else:
             MacroManager.logger.info("Key combination not found!")
 
@@ -43,3 +49,4 @@ class MacroManager:
     def add_actions(hotkey, actions):
         MacroManager.logger.info(f"addint {hotkey}, {actions}")
         MacroManager.MACROS[hotkey] = actions
+        MacroManager.version += 1
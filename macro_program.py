@@ -0,0 +1,254 @@
+import hashlib
+import json
+from collections import namedtuple
+from types import MappingProxyType
+
+from custom_logger import CustomLogger
+from macro_manager import MacroManager
+from observer_interface import Observer
+from payload_codec import BinaryCodec, CODECS
+
+"""
+Macros compiled once into immutable programs.
+
+A macro in MacroManager.MACROS is a list of command strings:
+
+    TEXT:Hello          type the text
+    KEYS:ctrl_l+right   press the keys together
+    DOWN:shift          hold a key until the matching UP:shift
+    UP:shift
+    WAIT:30             pause for 30 ms (fractions allowed)
+    REPEAT:10           run the commands up to the matching END ten times, blocks can nest
+    END
+    EXIT:               end the server's connection
+
+compile_macro turns it into a MacroProgram: a tuple of MacroSteps, each holding the payload and its wire
+bytes for every codec in payload_codec.CODECS, so firing a macro only hands cached bytes to the writer.
+Key names are validated at compile time, a broken command is logged once and left out of the program
+instead of failing on every firing. REPEAT blocks are unrolled, a macro whose REPEAT/END blocks don't parse
+(a count that is not a whole number, an unmatched END or REPEAT) is rejected as a whole and compiles to a
+program without steps. Keys still held at the end of the macro get an UP appended, so a macro can never
+leave a key stuck down.
+
+A macro with WAIT: steps is timed: it is sent as one sequence payload and the executing side runs it on
+an action_scheduler.ActionScheduler so the waits are not stretched by the network.
+
+MacroPrograms keeps the programs of MacroManager.MACROS and recompiles lazily when MacroManager.version
+changes, reusing the program of every hotkey whose commands did not change.
+
+A program made of text and keys steps only can also run on the server: its run step is a single
+{"type": "run_macro", "data": {"hotkey", "digest"}} payload and the server expands it from its own copy of
+the synced macro table, a MacroTable. The digest covers the command list, so the server only expands a
+macro when its copy is identical and answers macro_miss otherwise, the client then sends the steps.
+"""
+
+module_logger = CustomLogger().get_logger("MacroProgramModuleLogger")
+
+# payload is never mutated once compiled, encoded maps codec name -> bytes
+MacroStep = namedtuple("MacroStep", "command payload encoded")
+# run is the run_macro step, None if the macro has steps only the client can handle. sequence is the
+# single payload a timed macro is sent as when it does not run by hotkey, None for untimed macros
+MacroProgram = namedtuple("MacroProgram", "hotkey commands steps digest run timed sequence")
+
+# Step types a server can expand a run_macro or a sequence into
+REMOTE_STEP_TYPES = ("text", "keys", "key_down", "key_up", "wait")
+# Unrolled REPEAT blocks can't grow a program past this
+MAX_PROGRAM_STEPS = 10000
+MAX_WAIT_MS = 60 * 60 * 1000
+
+
+class MacroCompileError(ValueError):
+    pass
+
+
+def parse_keys(keys):
+    """Validated key names of a KEYS: command, names of more than one character are lower cased like pyautogui"""
+    names = []
+    for key in keys.split('+'):
+        key = key.strip()
+        if not key:
+            raise MacroCompileError(f"Empty key name in {keys!r}")
+        if not key.isprintable() or any(char.isspace() for char in key):
+            raise MacroCompileError(f"Invalid key name {key!r} in {keys!r}")
+        names.append(key.lower() if len(key) > 1 else key)
+    return names
+
+
+def parse_key(key):
+    names = parse_keys(key)
+    if len(names) != 1:
+        raise MacroCompileError(f"Expected a single key, got {key!r}")
+    return names[0]
+
+
+def parse_number(command, prefix, limit):
+    try:
+        value = float(command[len(prefix):].strip())
+    except ValueError:
+        raise MacroCompileError(f"Expected a number in {command!r}") from None
+    if not 0 <= value <= limit:
+        raise MacroCompileError(f"{command!r} is out of range, 0 to {limit}")
+    return value
+
+
+def compile_command(command):
+    """Payload of one command string, raises MacroCompileError for an unknown command or a bad argument"""
+    if command.startswith("EXIT:"):
+        return {"type": "exit"}
+    if command.startswith("TEXT:"):
+        return {"type": "text", "data": command[len("TEXT:"):].strip()}
+    if command.startswith("KEYS:"):
+        return {"type": "keys", "data": parse_keys(command[len("KEYS:"):])}
+    if command.startswith("DOWN:"):
+        return {"type": "key_down", "data": parse_key(command[len("DOWN:"):])}
+    if command.startswith("UP:"):
+        return {"type": "key_up", "data": parse_key(command[len("UP:"):])}
+    if command.startswith("WAIT:"):
+        return {"type": "wait", "data": parse_number(command, "WAIT:", MAX_WAIT_MS)}
+    raise MacroCompileError(f"Invalid command {command!r}, use TEXT:, KEYS:, DOWN:, UP:, WAIT:, REPEAT:/END or "
+                            f"EXIT: as a prefix")
+
+
+def macro_digest(commands):
+    """Hex digest of a command list, identical macros on client and server have the same one"""
+    return hashlib.blake2b(json.dumps(list(commands)).encode(), digest_size=BinaryCodec.DIGEST_SIZE).hexdigest()
+
+
+def encode_step(command, payload):
+    encoded = MappingProxyType({name: codec.encode(payload) for name, codec in CODECS.items()})
+    return MacroStep(command, payload, encoded)
+
+
+def compile_step(command):
+    return encode_step(command, compile_command(command))
+
+
+def parse_count(command):
+    count = parse_number(command, "REPEAT:", MAX_PROGRAM_STEPS)
+    if not count.is_integer():
+        raise MacroCompileError(f"{command!r} needs a whole number of repeats")
+    return int(count)
+
+
+def unroll(hotkey, commands):
+    """
+    Steps of the commands with every REPEAT block expanded. A broken command is skipped, a broken block
+    structure raises MacroCompileError since there is no telling which commands were meant to repeat
+    """
+    # One (repeat count, steps) per open block, the bottom one is the macro itself
+    blocks = [(1, [])]
+    for command in commands:
+        if command.startswith("REPEAT:"):
+            blocks.append((parse_count(command), []))
+        elif command.strip() in ("END", "END:"):
+            if len(blocks) == 1:
+                raise MacroCompileError("END without a REPEAT")
+            count, body = blocks.pop()
+            if len(blocks[-1][1]) + count * len(body) > MAX_PROGRAM_STEPS:
+                raise MacroCompileError(f"REPEAT:{count} makes the macro longer than {MAX_PROGRAM_STEPS} steps")
+            blocks[-1][1].extend(body * count)
+        else:
+            try:
+                blocks[-1][1].append(compile_step(command))
+            except MacroCompileError as e:
+                module_logger.error(f"Macro {hotkey}: {e}, step skipped")
+    if len(blocks) > 1:
+        raise MacroCompileError("REPEAT without an END")
+    return blocks[0][1]
+
+
+def release_held_keys(hotkey, steps):
+    held = []
+    for step in steps:
+        if step.payload["type"] == "key_down" and step.payload["data"] not in held:
+            held.append(step.payload["data"])
+        elif step.payload["type"] == "key_up" and step.payload["data"] in held:
+            held.remove(step.payload["data"])
+    for key in held:
+        module_logger.warning(f"Macro {hotkey}: {key} is never released, adding UP:{key}")
+        steps.append(compile_step(f"UP:{key}"))
+    return steps
+
+
+def compile_macro(hotkey, commands):
+    try:
+        steps = release_held_keys(hotkey, unroll(hotkey, commands))
+    except MacroCompileError as e:
+        module_logger.error(f"Macro {hotkey} rejected: {e}")
+        steps = []
+    digest = macro_digest(commands)
+    remote = bool(steps) and all(step.payload["type"] in REMOTE_STEP_TYPES for step in steps)
+    timed = any(step.payload["type"] == "wait" for step in steps)
+    run = sequence = None
+    if remote:
+        run = encode_step(f"RUN:{hotkey}", {"type": "run_macro", "data": {"hotkey": hotkey, "digest": digest}})
+        if timed:
+            sequence = encode_step(f"SEQUENCE:{hotkey}", {"type": "sequence",
+                                                          "data": [step.payload for step in steps]})
+    return MacroProgram(hotkey, tuple(commands), tuple(steps), digest, run, timed, sequence)
+
+
+class MacroPrograms:
+    def __init__(self):
+        self.logger = CustomLogger().get_logger("MacroProgramsClassLogger")
+        self.programs = {}
+        self.programs_version = None
+
+    def rebuild(self):
+        version = MacroManager.version
+        programs = {}
+        compiled = 0
+        for hotkey, commands in list(MacroManager.get_macros().items()):
+            program = self.programs.get(hotkey)
+            if program is None or program.commands != tuple(commands):
+                program = compile_macro(hotkey, commands)
+                compiled += 1
+            programs[hotkey] = program
+        self.programs = programs
+        self.programs_version = version
+        self.logger.info(f"Macro programs rebuilt, {compiled} of {len(programs)} compiled")
+
+    def get(self, hotkey):
+        """Program of hotkey, None if there is no such macro"""
+        if self.programs_version != MacroManager.version:
+            self.rebuild()
+        return self.programs.get(hotkey)
+
+
+class MacroTable(Observer):
+    """
+    Server side programs of a MacroDBManager's macros, the hot table run_macro is expanded from.
+
+    Programs are compiled on first use from the manager's in-memory macro cache. As an observer of the
+    manager it drops the program of every hotkey a transaction touches, local edits and synced batches alike.
+    """
+
+    def __init__(self, db_manager):
+        self.logger = CustomLogger().get_logger("MacroTableClassLogger")
+        self.db_manager = db_manager
+        self.programs = {}
+        db_manager.register_observers(self)
+
+    def update(self, transaction):
+        self.programs.pop(transaction.get("hotkey"), None)
+        if transaction.get("old_hotkey"):
+            self.programs.pop(transaction.get("old_hotkey"), None)
+
+    def get(self, hotkey):
+        program = self.programs.get(hotkey)
+        if program is None:
+            macro = self.db_manager.get_macro(hotkey)
+            if macro is None:
+                return None
+            program = self.programs[hotkey] = compile_macro(hotkey, macro.actions)
+        return program
+
+    def expand(self, hotkey, digest):
+        """Payloads of the macro if the table has it with the same digest, None otherwise"""
+        program = self.get(hotkey)
+        if program is None or program.digest != digest or program.run is None:
+            return None
+        return [step.payload for step in program.steps]
+
+    def close(self):
+        self.db_manager.remove_observer(self)
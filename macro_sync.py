@@ -0,0 +1,256 @@
+import hashlib
+import json
+import zlib
+
+from custom_logger import CustomLogger
+
+"""
+Revision based macro sync between a master (Client) and a slave (Server).
+
+Every change to a MacroDBManager table is recorded with a monotonic revision.
+On connect the client sends SYNC_HELLO with its DB id, the server answers with
+SYNC_STATE: the last revision of that DB it applied and a checksum per chunk of
+its macro table. The client then sends:
+
+ * nothing, when the revisions and checksums match
+ * SYNC_MACROS with only the changes after the server's revision, when the gap
+   is small enough and still covered by the change log
+ * SYNC_SNAPSHOT with the macros of the chunks whose checksums differ, when the
+   revisions match but the tables drifted apart
+ * a full SYNC_SNAPSHOT otherwise
+
+Chunks are assigned by a hash of the hotkey, so adding or removing one macro
+only changes the checksum of the chunk it lives in.
+"""
+
+module_logger = CustomLogger().get_logger("MacroSyncModuleLogger")
+
+CHECKSUM_CHUNKS = 64
+# Above this many missing changes a snapshot is cheaper than replaying the log
+SYNC_MAX_DELTA = 1000
+
+
+def chunk_of(hotkey):
+    return zlib.crc32(hotkey.encode('utf-8')) % CHECKSUM_CHUNKS
+
+
+def table_checksums(macros):
+    """Checksum per chunk of a hotkey -> actions table"""
+    chunks = [[] for _ in range(CHECKSUM_CHUNKS)]
+    for hotkey, actions in macros.items():
+        chunks[chunk_of(hotkey)].append((hotkey, json.dumps(actions, separators=(',', ':'))))
+    checksums = []
+    for entries in chunks:
+        digest = hashlib.blake2b(digest_size=8)
+        for hotkey, actions in sorted(entries):
+            digest.update(hotkey.encode('utf-8'))
+            digest.update(b'\x00')
+            digest.update(actions.encode('utf-8'))
+            digest.update(b'\x00')
+        checksums.append(digest.hexdigest())
+    return checksums
+
+
+def build_sync_state(db_manager, db_id):
+    """Server side answer to SYNC_HELLO"""
+    return {
+        "type": "SYNC_STATE",
+        "data": {
+            "revision": db_manager.get_peer_revision(db_id),
+            "checksums": db_manager.table_checksums(),
+        },
+    }
+
+
+def plan_sync(db_manager, peer_state):
+    """Client side, returns the payload that brings the peer up to date or None if it already is"""
+    db_id = db_manager.get_db_id()
+    peer_revision = peer_state.get("revision", 0)
+    peer_checksums = peer_state.get("checksums") or []
+    local_revision = db_manager.latest_revision()
+    local_checksums = db_manager.table_checksums()
+
+    if peer_revision == local_revision:
+        stale_chunks = [chunk for chunk, checksum in enumerate(local_checksums)
+                        if chunk >= len(peer_checksums) or peer_checksums[chunk] != checksum]
+        if not stale_chunks:
+            module_logger.info(f"Peer is in sync at revision {local_revision}")
+            return None
+        module_logger.warning(f"Peer is at revision {local_revision} but {len(stale_chunks)} chunk(s) drifted")
+        return build_snapshot(db_manager, db_id, local_revision, stale_chunks)
+
+    gap = local_revision - peer_revision
+    if 0 < gap <= SYNC_MAX_DELTA and peer_revision >= db_manager.oldest_revision() - 1:
+        changes, stats = compact_transactions(db_manager.get_changes_since(peer_revision))
+        module_logger.info(f"Sending {len(changes)} change(s) from revision {peer_revision} to {local_revision}, "
+                           f"compaction removed {stats['removed']}")
+        return {
+            "type": "SYNC_MACROS",
+            "data": changes,
+            "db_id": db_id,
+            "base_revision": peer_revision,
+            "revision": local_revision,
+            "checksums": local_checksums,
+        }
+
+    module_logger.info(f"Peer revision {peer_revision} cannot be caught up from {local_revision}, sending snapshot")
+    return build_snapshot(db_manager, db_id, local_revision, None)
+
+
+def build_snapshot(db_manager, db_id, revision, chunks):
+    wanted = set(chunks) if chunks is not None else None
+    macros = {item['hotkey']: item['actions'] for item in db_manager.get_all_macros()
+              if wanted is None or chunk_of(item['hotkey']) in wanted}
+    return {
+        "type": "SYNC_SNAPSHOT",
+        "data": {"chunks": chunks, "macros": macros},
+        "db_id": db_id,
+        "revision": revision,
+    }
+
+
+def snapshot_transactions(db_manager, snapshot):
+    """Turns a snapshot into the transactions that make the local table match it"""
+    chunks = snapshot.get("chunks")
+    wanted = set(chunks) if chunks is not None else None
+    macros = snapshot.get("macros", {})
+    current = {item['hotkey']: item['actions'] for item in db_manager.get_all_macros()}
+    transactions = []
+    for hotkey, actions in current.items():
+        if wanted is not None and chunk_of(hotkey) not in wanted:
+            continue
+        if hotkey not in macros:
+            transactions.append({'operation': 'delete', 'hotkey': hotkey, 'actions': None, 'old_hotkey': None})
+        elif macros[hotkey] != actions:
+            transactions.append({'operation': 'edit', 'hotkey': hotkey, 'actions': macros[hotkey],
+                                 'old_hotkey': hotkey})
+    for hotkey, actions in macros.items():
+        if hotkey not in current:
+            transactions.append({'operation': 'add', 'hotkey': hotkey, 'actions': actions, 'old_hotkey': None})
+    return transactions
+
+
+def apply_sync_macros(db_manager, payload):
+    """Server side handling of SYNC_MACROS, records the peer revision once the batch is applied"""
+    db_id = payload.get("db_id")
+    if db_id is None or payload.get("revision") is None:
+        # Sent by a peer without revision support, nothing to track
+        return db_manager.apply_transactions(payload["data"])
+    known_revision = db_manager.get_peer_revision(db_id)
+    if payload["revision"] <= known_revision:
+        # Replayed after a newer batch, applying it would roll the table back
+        module_logger.info(f"Skipping stale batch at revision {payload['revision']} from {db_id}, "
+                           f"already at {known_revision}")
+        return True
+    if not db_manager.apply_transactions(payload["data"]):
+        return False
+    base_revision = payload.get("base_revision", 0)
+    if known_revision < base_revision:
+        module_logger.warning(f"Missing changes {known_revision + 1}..{base_revision} from {db_id}, "
+                              f"keeping revision {known_revision} so they get resent")
+        return True
+    checksums = payload.get("checksums")
+    if checksums is not None and checksums != db_manager.table_checksums():
+        # Forget the revision so the next connect reconciles with a snapshot
+        module_logger.warning(f"Table drifted from {db_id} after applying revision {payload['revision']}")
+        db_manager.set_peer_revision(db_id, -1)
+        return True
+    db_manager.set_peer_revision(db_id, payload["revision"])
+    return True
+
+
+def apply_snapshot(db_manager, payload):
+    """Server side handling of SYNC_SNAPSHOT"""
+    transactions = snapshot_transactions(db_manager, payload["data"])
+    module_logger.info(f"Snapshot from {payload.get('db_id')} needs {len(transactions)} change(s)")
+    if not db_manager.apply_transactions(transactions):
+        return False
+    db_manager.set_peer_revision(payload["db_id"], payload["revision"])
+    return True
+
+
+def compact_transactions(transactions):
+    """
+    Collapses a transaction log to the net effect per hotkey, following old_hotkey renames through the chain.
+
+    The log is assumed to have been valid against the sender's table, which is what the receiver mirrors,
+    so an add followed by edits and a delete of the same hotkey cancels out entirely. Returns the compacted
+    transactions and stats about how many operations were removed. If renames form a cycle the log is
+    returned unchanged.
+    """
+    # Current hotkey -> {'origin': hotkey before this batch or None if created here, 'actions': ...}
+    entries = {}
+    # Hotkeys that existed before the batch and are gone at the end of it
+    deleted = {}
+    for transaction in transactions:
+        operation = transaction.get("operation")
+        hotkey = transaction.get("hotkey")
+        actions = transaction.get("actions")
+        if operation == "add":
+            if hotkey in entries:
+                entries[hotkey]['actions'] = actions
+            elif deleted.pop(hotkey, False):
+                entries[hotkey] = {'origin': hotkey, 'actions': actions}
+            else:
+                entries[hotkey] = {'origin': None, 'actions': actions}
+        elif operation == "edit":
+            current = transaction.get("old_hotkey") or hotkey
+            if current != hotkey and hotkey in entries:
+                return _uncompacted(transactions, "rename onto a hotkey that is still in use")
+            entry = entries.pop(current, None) or {'origin': current, 'actions': actions}
+            entry['actions'] = actions
+            entries[hotkey] = entry
+        elif operation == "delete":
+            entry = entries.pop(hotkey, None)
+            if entry is None:
+                deleted[hotkey] = True
+            elif entry['origin'] is not None:
+                deleted[entry['origin']] = True
+        else:
+            return _uncompacted(transactions, f"unknown operation {operation}")
+
+    renames = {}
+    compacted = [{'operation': 'delete', 'hotkey': hotkey, 'actions': None, 'old_hotkey': None}
+                 for hotkey in deleted]
+    edits = []
+    adds = []
+    for hotkey, entry in entries.items():
+        if entry['origin'] is None:
+            adds.append({'operation': 'add', 'hotkey': hotkey, 'actions': entry['actions'], 'old_hotkey': None})
+        elif entry['origin'] == hotkey:
+            edits.append({'operation': 'edit', 'hotkey': hotkey, 'actions': entry['actions'], 'old_hotkey': hotkey})
+        else:
+            renames[entry['origin']] = {'operation': 'edit', 'hotkey': hotkey, 'actions': entry['actions'],
+                                        'old_hotkey': entry['origin']}
+
+    # A rename onto a hotkey that is itself renamed away has to wait until that one has been sent
+    ordered = []
+    state = {}
+    for origin in renames:
+        stack = [origin]
+        while stack:
+            current = stack[-1]
+            if state.get(current) == "done":
+                stack.pop()
+                continue
+            state[current] = "visiting"
+            target = renames[current]['hotkey']
+            if target in renames and state.get(target) != "done":
+                if state.get(target) == "visiting":
+                    return _uncompacted(transactions, "renames form a cycle")
+                stack.append(target)
+                continue
+            state[current] = "done"
+            ordered.append(renames[current])
+            stack.pop()
+
+    compacted.extend(ordered)
+    compacted.extend(edits)
+    compacted.extend(adds)
+    stats = {'input': len(transactions), 'output': len(compacted), 'removed': len(transactions) - len(compacted)}
+    return compacted, stats
+
+
+def _uncompacted(transactions, reason):
+    module_logger.warning(f"Not compacting {len(transactions)} transactions: {reason}")
+    return list(transactions), {'input': len(transactions), 'output': len(transactions), 'removed': 0}
@@ -2,12 +2,41 @@ from tkinter import ttk
 
 from custom_logger import CustomLogger
 
+# Used until the tree has been laid out and its real height is known
+DEFAULT_VISIBLE_ROWS = 20
+DEFAULT_ROW_HEIGHT = 20
+HEADER_HEIGHT = 25
+
 
 class MacroActionTree:
+    """
+    Treeview of macros that only renders the rows currently in view.
+
+    All macros live in a plain list (display order) plus a hotkey -> action index and a hotkey -> position
+    map, so lookups by hotkey are O(1) and loading a big library is just building those. A removed row is
+    left as None in the list and the list is compacted once before the next render, so removing many
+    macros in one go doesn't shift the list once per macro. The Treeview itself only holds one item per
+    visible row and those items are reused while scrolling, with the scrollbar driven from the model
+    instead of the Treeview.
+    """
 
     def __init__(self, master, row_num):
         self.logger = CustomLogger().get_logger("MacroActionTreeClassLogger")
         self.last_used_row = row_num
+        # Model, hotkeys in display order (None for removed rows until compacted), the hotkey -> action index
+        # and the hotkey -> position in rows map
+        self.rows = []
+        self.index = {}
+        self.positions = {}
+        self.removed = 0
+        # View, first model row shown and the Treeview items currently showing rows
+        self.offset = 0
+        self.visible_rows = DEFAULT_VISIBLE_ROWS
+        self.slots = []
+        self.slot_rows = {}
+        self.selected = None
+        self.render_pending = False
+
         # Container frame for Treeview and Scrollbars
         self.container = ttk.Frame(master)
         self.container.grid(row=self.last_used_row, sticky='nsew')
@@ -17,15 +46,16 @@ class MacroActionTree:
         master.grid_columnconfigure(0, weight=1)
 
         # Treeview
-        self.tree = ttk.Treeview(self.container, columns=("Macros", "Actions"), show="headings")
+        self.tree = ttk.Treeview(self.container, columns=("Macros", "Actions"), show="headings",
+                                 selectmode="browse", height=DEFAULT_VISIBLE_ROWS)
         self.tree.heading("Macros", text="Macros")
         self.tree.heading("Actions", text="Actions")
         self.tree.column("Macros", width=200)
         self.tree.column("Actions", width=400)
+        self.row_height = self._lookup_row_height()
 
-        # Vertical Scrollbar
-        self.vsb = ttk.Scrollbar(self.container, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=self.vsb.set)
+        # Vertical Scrollbar, scrolls the model rather than the Treeview
+        self.vsb = ttk.Scrollbar(self.container, orient="vertical", command=self.yview)
 
         # Horizontal Scrollbar
         self.hsb = ttk.Scrollbar(self.container, orient="horizontal", command=self.tree.xview)
@@ -41,57 +71,210 @@ class MacroActionTree:
         self.container.grid_rowconfigure(row_num, weight=1)
         self.container.grid_columnconfigure(0, weight=1)
 
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll_rows(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll_rows(3))
+        self.tree.bind("<Up>", lambda event: self.move_selection(-1))
+        self.tree.bind("<Down>", lambda event: self.move_selection(1))
+
+    def _lookup_row_height(self):
+        try:
+            return int(ttk.Style().lookup("Treeview", "rowheight")) or DEFAULT_ROW_HEIGHT
+        except (TypeError, ValueError):
+            return DEFAULT_ROW_HEIGHT
+
     def insert(self, macro, action):
-        item = self.find_item_by_macro(macro)
-        if item:
+        if self.find_item_by_macro(macro):
             self.logger.info(f"Skipping add of {macro} since it exists in tree")
             return
         self.logger.debug(f"Adding {macro}to tree")
-        self.tree.insert("", "end", values=(macro, action))
+        self._append(macro, action)
+        self.schedule_render()
+
+    def bulk_insert(self, items):
+        """Append many (macro, action) pairs at once, macros already in the tree are skipped"""
+        added = 0
+        for macro, action in items:
+            if macro in self.index:
+                continue
+            self._append(macro, action)
+            added += 1
+        self.logger.info(f"Bulk inserted {added} macros into tree")
+        self.schedule_render()
+
+    def load(self, items):
+        """Replace the whole tree with the given (macro, action) pairs"""
+        self.rows = []
+        self.index = {}
+        self.positions = {}
+        self.removed = 0
+        self.offset = 0
+        self.selected = None
+        self.bulk_insert(items)
 
     def edit_selected(self, new_macro, new_action):
-        selected_item = self.tree.selection()
-        if selected_item:
-            self.tree.item(selected_item, values=(new_macro, new_action))
+        if self.selected is not None and self._replace(self.selected, new_macro, new_action):
+            self.selected = new_macro
 
     def delete_selected(self):
-        selected_item = self.tree.selection()
-        if selected_item:
-            self.tree.delete(selected_item)
+        if self.selected is not None:
+            self._remove(self.selected)
+            self.selected = None
 
     def get_all(self):
-        items = self.tree.get_children()
-        return [(self.tree.item(item, "values")[0], self.tree.item(item, "values")[1]) for item in items]
+        self._compact()
+        return [(macro, self.index[macro]) for macro in self.rows]
 
     def get_selected(self):
-        selected_item = self.tree.selection()
-        if selected_item:
-            return self.tree.item(selected_item, "values")
+        """(hotkey, actions) of the selected macro, whether its row is on screen or not, (None, None) without one"""
+        if self.selected is not None:
+            return self.selected, self.index[self.selected]
         return None, None
 
     def clear_items(self):
         # clear all the items from the treeview
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        self.load([])
 
     def find_item_by_macro(self, macro):
-        for item in self.tree.get_children():
-            if self.tree.item(item, "value")[0] == macro:
-                return item
-        return None
+        return macro in self.index
 
     def edit_by_macro(self, macro, new_macro, new_action):
         """Edit an item based on its macro value"""
-        item = self.find_item_by_macro(macro)
-        if item:
-            self.tree.item(item, values=(new_macro, new_action))
+        if self.find_item_by_macro(macro):
+            if self._replace(macro, new_macro, new_action) and self.selected == macro:
+                self.selected = new_macro
         else:
             self.logger.warning(f"Hotkey:{macro} does not exist, skipping edit")
 
     def delete_by_macro(self, macro):
         """Delete an item based on its macro value"""
-        item = self.find_item_by_macro(macro)
-        if item:
-            self.tree.delete(item)
+        if self.find_item_by_macro(macro):
+            self._remove(macro)
+            if self.selected == macro:
+                self.selected = None
         else:
             self.logger.warning(f"hotkey:{macro} does not exists, skipping delete")
+
+    def _replace(self, macro, new_macro, new_action):
+        if new_macro != macro:
+            if new_macro in self.index:
+                self.logger.warning(f"Hotkey:{new_macro} already in tree, skipping rename of {macro}")
+                return False
+            position = self.positions.pop(macro)
+            self.rows[position] = new_macro
+            self.positions[new_macro] = position
+            del self.index[macro]
+        self.index[new_macro] = new_action
+        self.schedule_render()
+        return True
+
+    def _append(self, macro, action):
+        self.positions[macro] = len(self.rows)
+        self.rows.append(macro)
+        self.index[macro] = action
+
+    def _remove(self, macro):
+        self.rows[self.positions.pop(macro)] = None
+        self.removed += 1
+        del self.index[macro]
+        self.schedule_render()
+
+    def _compact(self):
+        # Drops the rows _remove left behind and renumbers the rest, once per batch of removals
+        if not self.removed:
+            return
+        self.rows = [macro for macro in self.rows if macro is not None]
+        self.positions = {macro: position for position, macro in enumerate(self.rows)}
+        self.removed = 0
+
+    def schedule_render(self):
+        # Coalesce every change made in the same Tk callback into one render
+        if not self.render_pending:
+            self.render_pending = True
+            self.tree.after_idle(self.render)
+
+    def render(self):
+        self.render_pending = False
+        self._compact()
+        self.offset = max(0, min(self.offset, len(self.rows) - self.visible_rows))
+        needed = min(self.visible_rows, len(self.rows) - self.offset)
+        while len(self.slots) < needed:
+            self.slots.append(self.tree.insert("", "end", values=("", "")))
+        while len(self.slots) > needed:
+            item = self.slots.pop()
+            self.slot_rows.pop(item, None)
+            self.tree.delete(item)
+
+        selected_item = None
+        for position, item in enumerate(self.slots):
+            macro = self.rows[self.offset + position]
+            self.tree.item(item, values=(macro, self.index[macro]))
+            self.slot_rows[item] = macro
+            if macro == self.selected:
+                selected_item = item
+        if selected_item is not None:
+            self.tree.selection_set(selected_item)
+        elif self.tree.selection():
+            self.tree.selection_remove(*self.tree.selection())
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        total = len(self.rows)
+        if total <= self.visible_rows:
+            self.vsb.set(0.0, 1.0)
+        else:
+            self.vsb.set(self.offset / total, (self.offset + self.visible_rows) / total)
+
+    def yview(self, *args):
+        if not args:
+            return
+        self._compact()
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * len(self.rows)))
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            if args[2] == "pages":
+                amount *= max(1, self.visible_rows - 1)
+            self.scroll_rows(amount)
+
+    def scroll_rows(self, amount):
+        self.scroll_to(self.offset + amount)
+        return "break"
+
+    def scroll_to(self, offset):
+        self._compact()
+        offset = max(0, min(offset, len(self.rows) - self.visible_rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def on_mouse_wheel(self, event):
+        # Windows reports multiples of 120 per notch, macOS reports small deltas
+        step = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self.scroll_rows(-3 * step if step else 0)
+
+    def on_resize(self, event):
+        visible_rows = max(1, (event.height - HEADER_HEIGHT) // self.row_height)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.render()
+
+    def on_select(self, event):
+        selection = self.tree.selection()
+        if selection and selection[0] in self.slot_rows:
+            self.selected = self.slot_rows[selection[0]]
+
+    def move_selection(self, amount):
+        if self.selected is None or self.selected not in self.index:
+            return None
+        self._compact()
+        position = max(0, min(self.positions[self.selected] + amount, len(self.rows) - 1))
+        self.selected = self.rows[position]
+        if position < self.offset:
+            self.offset = position
+        elif position >= self.offset + self.visible_rows:
+            self.offset = position - self.visible_rows + 1
+        self.render()
+        return "break"
@@ -5,35 +5,36 @@ import random
 import socket
 import sys
 import threading
-from tkinter import Tk, StringVar, Radiobutton, Entry, Button, Label, messagebox, simpledialog
-
-import pyautogui
+import time
+from tkinter import Tk, StringVar, BooleanVar, Radiobutton, Checkbutton, Entry, Button, Label, messagebox, \
+    simpledialog
 
 from custom_logger import CustomLogger
 from observer_interface import Observer
 from socket_server import Server
-from db_manager import MacroDBManager
+from async_server import AsyncServer
 from macro_manager import MacroManager
+from macro_sync import compact_transactions
 from macro_tree import MacroActionTree
-from socket_client import Client, hash_challenge
+from tk_dispatcher import TkObserverDispatcher
+from socket_client import Client, FanoutClient, hash_challenge
 from constants_manager import ConstantsManager
+from lazy_module import LazyModule
 
 # Getting a logger for the modulw level logging
 module_logger = CustomLogger().get_logger("MainModuleLogger")
 
+# Only needed once the legacy server functions below inject something
+pyautogui = LazyModule("pyautogui")
+
 # Constants and shared functions
-# Initialize the ConstantsManager with a database URL
+# Initialize the ConstantsManager with a database URL, constants are read when they are used so nothing
+# touches the DB before the window is up
 database_url = "sqlite:///constants.db"  # Using SQLite for this example
 constants_manager = ConstantsManager(database_url)
 
-
-HOST = constants_manager.get('HOST')
-PORT = constants_manager.get('PORT')
-SHARED_SECRET = constants_manager.get('SHARED_SECRET')
-DB_NAME = constants_manager.get('DB_NAME')
-BUFFER_SIZE = constants_manager.get('BUFFER_SIZE')
-AUTH_SUCCESS = constants_manager.get('AUTH_SUCCESS')
-AUTH_FAILED = constants_manager.get('AUTH_FAILED')
+# Where the Dump Stats button writes the timing stats
+STATS_FILE = "perf_stats.json"
 
 """
 Server Functions--------------------
@@ -43,7 +44,7 @@ Server Functions--------------------
 def listen_for_data():
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((HOST, PORT))
+            s.bind((constants_manager.get('HOST'), constants_manager.get('PORT')))
             s.listen()
             module_logger.info("Listening for input...")
 
@@ -59,23 +60,23 @@ def handle_server_connection(connection, addr):
 
         if authenticate_client_with_server(connection):
             module_logger.info("Authentication successful!")
-            connection.sendall(AUTH_SUCCESS.encode())
+            connection.sendall(constants_manager.get('AUTH_SUCCESS').encode())
             main_server_loop(connection)
         else:
             module_logger.error("Authentication failed!")
-            connection.sendall(AUTH_FAILED.encode())
+            connection.sendall(constants_manager.get('AUTH_FAILED').encode())
 
 
 def authenticate_client_with_server(connection):
     challenge = generate_challenge()
     connection.sendall(challenge.encode())
-    response = connection.recv(BUFFER_SIZE).decode()
+    response = connection.recv(constants_manager.get('BUFFER_SIZE')).decode()
     return validate_response(response, challenge)
 
 
 def main_server_loop(connection):
     while True:
-        data_received = connection.recv(BUFFER_SIZE).decode()
+        data_received = connection.recv(constants_manager.get('BUFFER_SIZE')).decode()
         if not data_received:
             module_logger.warning("Connection lost...")
             break
@@ -136,7 +137,8 @@ class App(Observer):
         self.logger = CustomLogger().get_logger("AppClassLogger")
         self.logger.info("Initializing app")
         self.listener = None
-        self.db_manager = MacroDBManager('sqlite:///./macrobs.db')
+        # Opened in load_macros, after the window is up
+        self.db_manager = None
         self.macro_tree = None
         self.service_to_run = None
         self.row_num = 0
@@ -149,11 +151,29 @@ class App(Observer):
         Radiobutton(root, text="Server", variable=self.mode, value="server").grid(row=self.row_num, column=0,
                                                                                   sticky="w")
         self.row_num += 1
+        Radiobutton(root, text="Server (multi-client)", variable=self.mode,
+                    value="async_server").grid(row=self.row_num, column=0, sticky="w")
+        self.row_num += 1
+
+        self.stream_mouse = BooleanVar(value=False)
+        Checkbutton(root, text="Stream mouse (client)", variable=self.stream_mouse).grid(row=self.row_num, column=0,
+                                                                                         sticky="w")
+        self.row_num += 1
+
+        self.datagrams = BooleanVar(value=False)
+        Checkbutton(root, text="Mouse over UDP", variable=self.datagrams).grid(row=self.row_num, column=0,
+                                                                             sticky="w")
+        self.row_num += 1
+
+        self.fail_fast = BooleanVar(value=False)
+        Checkbutton(root, text="Stop when a server fails (several IPs)",
+                    variable=self.fail_fast).grid(row=self.row_num, column=0, sticky="w")
+        self.row_num += 1
 
-        Label(root, text="Server IP Address:").grid(row=self.row_num, column=0, sticky="e")
+        # A comma separated list drives every listed server at once
+        Label(root, text="Server IP Address(es):").grid(row=self.row_num, column=0, sticky="e")
         self.ip_entry = Entry(root)
         self.ip_entry.grid(row=self.row_num, column=1)
-        self.ip_entry.insert(0, HOST)
         self.row_num += 1
 
         self.start_button = Button(root, text="Start", command=self.start)
@@ -178,10 +198,23 @@ class App(Observer):
         self.delete_button = Button(root, text="Delete Macro", command=self.delete_macro)
         self.delete_button.grid(row=self.row_num, column=2)
 
+        self.stats_button = Button(root, text="Dump Stats", command=self.dump_stats)
+        self.stats_button.grid(row=self.row_num, column=3)
+
         self.running = False
         self.current_thread = None
+        # Open the constants and macro DBs once the window is up instead of before it is shown
+        root.after_idle(self.load_macros, root)
+
+    def load_macros(self, root):
+        # Importing db_manager pulls in SQLAlchemy, which is most of the startup time
+        from db_manager import MacroDBManager
+
+        self.ip_entry.insert(0, constants_manager.get('HOST'))
+        self.db_manager = MacroDBManager('sqlite:///./macrobs.db')
         self.check_initial_db_for_macros()
-        self.db_manager.register_observers(App.instance)
+        # Observer calls can come from the socket threads, the dispatcher moves them onto the Tk loop
+        self.db_manager.register_observers(TkObserverDispatcher(root, App.instance))
 
     def update(self, transaction):
         self.logger.info(f"Updating Tree with incoming transaction {transaction}")
@@ -194,10 +227,19 @@ class App(Observer):
         if operation == "add":
             self.macro_tree.insert(hotkey, actions)
         elif operation == "edit":
-            self.macro_tree.edit_by_macro(old_hotkey, hotkey, actions)
+            # In-place edits may come without old_hotkey
+            self.macro_tree.edit_by_macro(old_hotkey or hotkey, hotkey, actions)
         elif operation == "delete":
             self.macro_tree.delete_by_macro(hotkey)
 
+    def update_batch(self, transactions):
+        # Only the net effect of the batch reaches the tree, Tk redraws once after this callback returns
+        compacted, stats = compact_transactions(transactions)
+        self.logger.info(f"Updating Tree with a batch of {stats['input']} transactions ({stats['output']} after "
+                         f"compaction)")
+        for transaction in compacted:
+            self.update(transaction)
+
     def check_initial_db_for_macros(self):
         check = self.db_manager.get_all_macros()
         if isinstance(check, list) and not check:
@@ -205,13 +247,13 @@ class App(Observer):
             for hotkey, actions in MacroManager.get_macros().items():
                 self.logger.info(f"Adding hotkey:{hotkey} and actions: {actions} to db")
                 self.db_manager.add_macro(hotkey, actions)
-                self.macro_tree.insert(hotkey, actions)
+            self.macro_tree.load(MacroManager.get_macros().items())
             self.logger.info("Clearing all DB transactions bc we loaded from MacroManager")
             self.db_manager.clear_transactions()
         elif isinstance(check, list):
             self.logger.info("Macros already in DB, skipping assigning defaults, but loading tree")
+            self.macro_tree.load((item['hotkey'], item['actions']) for item in check)
             for item in check:
-                self.macro_tree.insert(item['hotkey'], item['actions'])
                 MacroManager.add_actions(item['hotkey'], item['actions'])
         else:
             messagebox.showerror("Error!", "Macros DB seems to be corrupt, shutting down..")
@@ -221,6 +263,8 @@ class App(Observer):
         constants_manager.set('HOST', self.ip_entry.get())
         if self.mode.get() == "client":
             self.start_client()
+        elif self.mode.get() == "async_server":
+            self.start_server(server_class=AsyncServer)
         else:
             self.start_server()
 
@@ -228,7 +272,14 @@ class App(Observer):
         if self.running:
             return
         try:
-            self.service_to_run = Client(HOST, PORT, self.db_manager)
+            hosts = [host.strip() for host in constants_manager.get('HOST').split(',') if host.strip()]
+            if len(hosts) > 1:
+                self.service_to_run = FanoutClient(hosts, constants_manager.get('PORT'), self.db_manager,
+                                                   fail_fast=self.fail_fast.get(),
+                                                   stream_mouse=self.stream_mouse.get())
+            else:
+                self.service_to_run = Client(hosts[0], constants_manager.get('PORT'), self.db_manager,
+                                             stream_mouse=self.stream_mouse.get(), datagrams=self.datagrams.get())
 
             self.current_thread = threading.Thread(target=self.service_to_run.start_client_services)
             self.current_thread.start()
@@ -238,12 +289,15 @@ class App(Observer):
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
-    def start_server(self):
+    def start_server(self, server_class=Server):
         if self.running:
             return
         try:
             # TODO: Finish this
-            self.service_to_run = Server(HOST, PORT, self.db_manager)
+            # A server only listens on one address, the first one if a list was entered
+            host = constants_manager.get('HOST').split(',')[0].strip()
+            self.service_to_run = server_class(host, constants_manager.get('PORT'), self.db_manager,
+                                               datagrams=self.datagrams.get())
             self.current_thread = threading.Thread(target=self.service_to_run.start)
             self.current_thread.start()
             self.running = True
@@ -253,6 +307,13 @@ class App(Observer):
             messagebox.showerror("Error", str(e))
 
     def stop(self):
+        if self.service_to_run is not None:
+            # Unsubscribes its constants and DB observers, otherwise every Start/Stop leaves a set behind
+            try:
+                self.service_to_run.close()
+            except Exception as e:
+                self.logger.error(f"Error while closing {type(self.service_to_run).__name__}: {e}")
+            self.service_to_run = None
         if self.current_thread and self.current_thread.is_alive():
             self.current_thread._stop()
 
@@ -275,6 +336,30 @@ class App(Observer):
                 self.check_and_send_db_transactions()
                 # self.service_to_run.send_data()
 
+    def dump_stats(self):
+        if self.service_to_run is None:
+            messagebox.showwarning("Warning", "Start the client or server first")
+            return
+        # Asking the server means waiting on the socket, so that happens off the Tk thread
+        threading.Thread(target=self.write_stats, name="StatsDump", daemon=True).start()
+        messagebox.showinfo("Stats", f"Writing timing stats to {STATS_FILE}")
+
+    def write_stats(self):
+        stats = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        try:
+            if isinstance(self.service_to_run, Client):
+                stats["client"] = self.service_to_run.stats.snapshot()
+                stats["remote"] = self.service_to_run.request_server_stats()
+                if isinstance(self.service_to_run, FanoutClient):
+                    stats["targets"] = self.service_to_run.target_stats()
+            else:
+                stats.update(self.service_to_run.collect_stats())
+            with open(STATS_FILE, "w") as f:
+                json.dump(stats, f, indent=2)
+            self.logger.info(f"Timing stats written to {STATS_FILE}")
+        except Exception as e:
+            self.logger.error(f"Could not dump timing stats: {e}")
+
     def check_and_send_db_transactions(self):
         transactions = self.db_manager.get_all_transactions()
         if transactions is not None:
@@ -290,12 +375,13 @@ class App(Observer):
             return
         new_macro = simpledialog.askstring("Edit", "Enter Macro:", initialvalue=macro)
         if new_macro is not None:
-            new_action = simpledialog.askstring("Edit", "Enter actions (separated by ','", initialvalue=actions)
+            new_action = simpledialog.askstring("Edit", "Enter actions (separated by ','",
+                                                initialvalue=", ".join(actions))
             if new_action is not None:
                 actions = create_actions_from_string(new_action)
-                self.macro_tree.edit_selected(new_macro, new_action)
+                self.macro_tree.edit_selected(new_macro, actions)
                 self.db_manager.edit_macro(macro, new_macro, actions)
-                MacroManager.edit_macro(macro, new_macro, new_action)
+                MacroManager.edit_macro(macro, new_macro, actions)
                 self.check_and_send_db_transactions()
 
     def delete_macro(self):
@@ -1,3 +1,7 @@
 class Observer:
     def update(self, transaction):
         pass
+
+    def update_batch(self, transactions):
+        for transaction in transactions:
+            self.update(transaction)
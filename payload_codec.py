@@ -0,0 +1,139 @@
+import json
+import struct
+
+"""
+Payload codecs used inside frames (see framing.py).
+
+JsonCodec is what both sides speak until they negotiate otherwise right after
+authentication. BinaryCodec packs the high rate payloads (keys, text and mouse
+moves) as a one byte type id followed by a packed body and falls back to an
+embedded JSON document for everything else, so any payload still round trips.
+"""
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, payload):
+        return json.dumps(payload).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class BinaryCodec:
+    name = "binary"
+
+    JSON_FALLBACK = 0
+    TEXT = 1
+    KEYS = 2
+    MOUSE_MOVE = 3
+    MOUSE_MOVE_REL = 4
+    EXIT = 5
+    ACK = 6
+    RUN_MACRO = 7
+    KEY_DOWN = 8
+    KEY_UP = 9
+    WAIT = 10
+
+    TYPE_IDS = {
+        "text": TEXT,
+        "keys": KEYS,
+        "mouse_move": MOUSE_MOVE,
+        "mouse_move_rel": MOUSE_MOVE_REL,
+        "exit": EXIT,
+        "ack": ACK,
+        "run_macro": RUN_MACRO,
+        "key_down": KEY_DOWN,
+        "key_up": KEY_UP,
+        "wait": WAIT,
+    }
+
+    POINT = struct.Struct("!Bii")
+    SEQUENCE = struct.Struct("!BQ")
+    MILLISECONDS = struct.Struct("!Bd")
+    KEY_SEPARATOR = b"\x00"
+    # Size of the macro digest carried by run_macro, see macro_program.macro_digest
+    DIGEST_SIZE = 8
+
+    def encode(self, payload):
+        type_id = self.TYPE_IDS.get(payload.get("type"))
+        # Only the plain {"type", "data"} shape is packed, anything carrying extra fields keeps them via JSON
+        if type_id is None or len(payload) > 2:
+            return self._encode_json(payload)
+        data = payload.get("data")
+        try:
+            if type_id == self.TEXT:
+                return bytes((self.TEXT,)) + data.encode('utf-8')
+            if type_id == self.KEYS:
+                return bytes((self.KEYS,)) + self.KEY_SEPARATOR.join(key.encode('utf-8') for key in data)
+            if type_id == self.MOUSE_MOVE:
+                return self.POINT.pack(self.MOUSE_MOVE, data["x"], data["y"])
+            if type_id == self.MOUSE_MOVE_REL:
+                return self.POINT.pack(self.MOUSE_MOVE_REL, data["dx"], data["dy"])
+            if type_id == self.ACK:
+                return self.SEQUENCE.pack(self.ACK, data)
+            if type_id in (self.KEY_DOWN, self.KEY_UP):
+                return bytes((type_id,)) + data.encode('utf-8')
+            if type_id == self.WAIT:
+                return self.MILLISECONDS.pack(self.WAIT, data)
+            if type_id == self.RUN_MACRO:
+                digest = bytes.fromhex(data["digest"])
+                if len(digest) == self.DIGEST_SIZE:
+                    return bytes((self.RUN_MACRO,)) + digest + data["hotkey"].encode('utf-8')
+            if data is None:
+                return bytes((self.EXIT,))
+        except (AttributeError, TypeError, KeyError, ValueError, struct.error):
+            pass
+        return self._encode_json(payload)
+
+    def decode(self, data):
+        type_id = data[0]
+        if type_id == self.TEXT:
+            return {"type": "text", "data": data[1:].decode('utf-8')}
+        if type_id == self.KEYS:
+            body = data[1:]
+            keys = [key.decode('utf-8') for key in body.split(self.KEY_SEPARATOR)] if body else []
+            return {"type": "keys", "data": keys}
+        if type_id == self.MOUSE_MOVE:
+            _, x, y = self.POINT.unpack(data)
+            return {"type": "mouse_move", "data": {"x": x, "y": y}}
+        if type_id == self.MOUSE_MOVE_REL:
+            _, dx, dy = self.POINT.unpack(data)
+            return {"type": "mouse_move_rel", "data": {"dx": dx, "dy": dy}}
+        if type_id == self.EXIT:
+            return {"type": "exit"}
+        if type_id == self.ACK:
+            return {"type": "ack", "data": self.SEQUENCE.unpack(data)[1]}
+        if type_id == self.KEY_DOWN:
+            return {"type": "key_down", "data": data[1:].decode('utf-8')}
+        if type_id == self.KEY_UP:
+            return {"type": "key_up", "data": data[1:].decode('utf-8')}
+        if type_id == self.WAIT:
+            return {"type": "wait", "data": self.MILLISECONDS.unpack(data)[1]}
+        if type_id == self.RUN_MACRO:
+            digest_end = 1 + self.DIGEST_SIZE
+            return {"type": "run_macro", "data": {"hotkey": data[digest_end:].decode('utf-8'),
+                                                  "digest": data[1:digest_end].hex()}}
+        if type_id == self.JSON_FALLBACK:
+            return json.loads(data[1:])
+        raise ValueError(f"Unknown binary payload type id: {type_id}")
+
+    def _encode_json(self, payload):
+        return bytes((self.JSON_FALLBACK,)) + json.dumps(payload).encode('utf-8')
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+
+# Order in which the client offers codecs, the server picks the first one it supports
+CODEC_PREFERENCE = [BINARY_CODEC.name, JSON_CODEC.name]
+
+
+def choose_codec(offered):
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
@@ -0,0 +1,81 @@
+import time
+
+"""
+Low overhead per stage timing for the hot paths of Server and Client.
+
+Each stage keeps a count, a total, a max and a histogram with one bucket per
+power of two nanoseconds, so recording a sample is a bit_length() and a few
+list updates. Hot paths call perf_counter_ns() themselves and hand the elapsed
+time to record(). Updates are not locked: a sample racing with another thread
+can at worst be lost, which is fine for monitoring and keeps it cheap enough to
+leave on in production.
+"""
+
+BUCKETS = 48
+COUNT, TOTAL, MAX, HISTOGRAM = range(4)
+
+
+class PerfStats:
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def record(self, stage, elapsed_ns):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0, 0, [0] * BUCKETS]
+        entry[COUNT] += 1
+        entry[TOTAL] += elapsed_ns
+        if elapsed_ns > entry[MAX]:
+            entry[MAX] = elapsed_ns
+        entry[HISTOGRAM][min(elapsed_ns.bit_length(), BUCKETS - 1)] += 1
+
+    def record_since(self, stage, start_ns):
+        """Record the time since start_ns, returns now so consecutive stages can chain"""
+        now = time.perf_counter_ns()
+        self.record(stage, now - start_ns)
+        return now
+
+    def increment(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def snapshot(self):
+        stages = {}
+        for stage, (count, total, max_ns, histogram) in list(self.stages.items()):
+            histogram = list(histogram)
+            stages[stage] = {
+                "count": count,
+                "mean_us": total / count / 1000 if count else 0.0,
+                "max_us": max_ns / 1000,
+                "p50_us": _percentile(histogram, count, 0.50),
+                "p99_us": _percentile(histogram, count, 0.99),
+                # Upper bound of each bucket in microseconds -> samples, empty buckets left out
+                "histogram": {f"{(1 << bucket) / 1000:g}": samples
+                              for bucket, samples in enumerate(histogram) if samples},
+            }
+        return {
+            "name": self.name,
+            "uptime_s": time.time() - self.started,
+            "stages": stages,
+            "counters": dict(self.counters),
+        }
+
+
+def _percentile(histogram, count, fraction):
+    """Upper bound of the bucket holding the percentile, in microseconds"""
+    if not count:
+        return 0.0
+    wanted = fraction * count
+    seen = 0
+    for bucket, samples in enumerate(histogram):
+        seen += samples
+        if seen >= wanted:
+            return (1 << bucket) / 1000
+    return (1 << (len(histogram) - 1)) / 1000
@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+"""
+Import time and memory profile of the GUI startup path.
+
+Every run imports newmain in a fresh interpreter inside a scratch directory, so constants.db, the macro DB
+and logging_config.yaml are created from scratch like on a first start. Two scenarios are compared:
+
+    lazy   importing newmain, which is all that happens before the window is built
+    eager  the same import followed by everything the old startup loaded at import time: pyautogui, pynput,
+           the constants DB, the macro DB and the logging config
+
+Usage:
+    python profile_startup.py [--repeat 5] [--importtime 15] [--json]
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = r"""
+import json, sys, time
+trace = sys.argv[2] == "trace"
+if trace:
+    import tracemalloc
+    tracemalloc.start()
+start = time.perf_counter()
+import newmain
+missing = []
+if sys.argv[1] == "eager":
+    import socket_client, socket_server
+    from custom_logger import CustomLogger
+    from db_manager import MacroDBManager
+    for lazy in (socket_server.pyautogui, socket_client.keyboard, socket_client.mouse):
+        try:
+            lazy.load()
+        except Exception as e:
+            missing.append(f"{lazy}: {e}")
+    CustomLogger().setup_logging()
+    newmain.constants_manager.get('HOST')
+    MacroDBManager('sqlite:///./macrobs.db').engine
+elapsed = time.perf_counter() - start
+result = {"elapsed_ms": elapsed * 1000, "modules": len(sys.modules), "missing": missing}
+if trace:
+    result["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+try:
+    import resource
+    # Kilobytes on Linux, bytes on macOS
+    scale = 1024 if sys.platform == "darwin" else 1
+    result["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+except ImportError:
+    pass
+print(json.dumps(result))
+"""
+
+
+def run_child(scenario, mode, extra_args=()):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+    with tempfile.TemporaryDirectory(prefix="profile_startup_") as cwd:
+        completed = subprocess.run([sys.executable, *extra_args, "-c", CHILD, scenario, mode], cwd=cwd, env=env,
+                                   capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{scenario} run failed:\n{completed.stderr}")
+    # Log output goes to stderr, the result is the last stdout line
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+def slowest_imports(stderr, count):
+    """Parses -X importtime output, returns the imports with the biggest cumulative time"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|").split("|")]
+        rows.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)[:count]
+
+
+def profile(scenario, repeat, importtime):
+    timings = [run_child(scenario, "time")[0] for _ in range(repeat)]
+    traced, _ = run_child(scenario, "trace")
+    result = {
+        "median_ms": statistics.median(run["elapsed_ms"] for run in timings),
+        "min_ms": min(run["elapsed_ms"] for run in timings),
+        "peak_traced_kb": traced["peak_kb"],
+        "maxrss_kb": statistics.median(run.get("maxrss_kb", 0) for run in timings),
+        "modules": timings[0]["modules"],
+        "missing": timings[0]["missing"],
+    }
+    if importtime:
+        _, stderr = run_child(scenario, "time", ("-X", "importtime"))
+        result["slowest_imports"] = slowest_imports(stderr, importtime)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile startup time and memory, lazy vs eager loading")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per scenario, the median is reported")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N",
+                        help="also list the N slowest imports of each scenario")
+    parser.add_argument("--json", action="store_true", help="print machine readable results")
+    args = parser.parse_args()
+
+    results = {scenario: profile(scenario, args.repeat, args.importtime) for scenario in ("lazy", "eager")}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'scenario':<10}{'median ms':>11}{'min ms':>10}{'peak KiB':>11}{'max RSS KiB':>13}{'modules':>9}")
+    for scenario, row in results.items():
+        print(f"{scenario:<10}{row['median_ms']:>11.1f}{row['min_ms']:>10.1f}{row['peak_traced_kb']:>11,.0f}"
+              f"{row['maxrss_kb']:>13,.0f}{row['modules']:>9}")
+    for scenario, row in results.items():
+        for missing in row["missing"]:
+            print(f"{scenario}: could not load {missing}")
+        if row.get("slowest_imports"):
+            print(f"\nSlowest imports ({scenario}):")
+            for entry in row["slowest_imports"]:
+                print(f"  {entry['cumulative_ms']:>9.1f} ms  {entry['module']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from custom_logger import CustomLogger
+from datagram_lane import datagram_key
+
+"""
+Resumable sessions kept by the server across connections.
+
+After the full handshake a client asks for a session with a {"type": "hello"} payload and gets back a
+session id and a secret token. From then on every frame it sends starts with a sequence number
+(framing.SEQUENCE). The server remembers the highest sequence it processed, drops anything at or below it
+and acks cumulatively, so frames the client replays after a reconnect are processed exactly once.
+
+A reconnecting client answers the challenge with
+
+    RESUME:<session id>:<sha256(challenge + token)>
+
+instead of the challenge hash, which skips authentication, codec negotiation and the macro sync. The
+server answers RESUMED:<last processed sequence> so the client knows where to replay from.
+"""
+
+RESUME_PREFIX = "RESUME:"
+RESUMED_PREFIX = "RESUMED:"
+# Least recently used sessions are forgotten past this, their clients fall back to the full handshake
+MAX_SESSIONS = 64
+
+
+def resume_proof(challenge, token):
+    return hashlib.sha256((challenge + token).encode()).hexdigest()
+
+
+class ResumableSession:
+    def __init__(self, codec):
+        self.session_id = secrets.token_hex(8)
+        self.token = secrets.token_hex(16)
+        self.codec = codec
+        self.last_sequence = 0
+        self.duplicates = 0
+        # Mouse datagrams have their own sequence, see datagram_lane.py
+        self.last_datagram = 0
+        self.datagram_key = datagram_key(self.token)
+        self.last_seen = time.monotonic()
+
+    def accept(self, sequence):
+        """True if the frame is new and should be processed, False for a replayed duplicate"""
+        if sequence <= self.last_sequence:
+            self.duplicates += 1
+            return False
+        self.last_sequence = sequence
+        return True
+
+
+class SessionRegistry:
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.logger = CustomLogger().get_logger("SessionRegistryClassLogger")
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, codec):
+        session = ResumableSession(codec)
+        with self.lock:
+            self.sessions[session.session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                session_id, _ = self.sessions.popitem(last=False)
+                self.logger.info(f"Forgot session {session_id}, too many sessions")
+        self.logger.info(f"Opened session {session.session_id}")
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def resume(self, response, challenge):
+        """Session for a RESUME: response to challenge, None if it is unknown or the proof is wrong"""
+        try:
+            session_id, proof = response[len(RESUME_PREFIX):].split(":", 1)
+        except ValueError:
+            return None
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                self.logger.warning(f"Client tried to resume unknown session {session_id}")
+                return None
+            if not hmac.compare_digest(proof, resume_proof(challenge, session.token)):
+                self.logger.warning(f"Wrong resume proof for session {session_id}")
+                return None
+            self.sessions.move_to_end(session_id)
+        session.last_seen = time.monotonic()
+        self.logger.info(f"Resumed session {session_id} at sequence {session.last_sequence}")
+        return session
@@ -1,132 +1,845 @@
 import hashlib
-import json
 import logging
+import queue
+import random
 import socket
+import threading
 import time
+from collections import deque
+from itertools import islice
 
-from pynput import keyboard
-
+from action_scheduler import ActionScheduler, WAIT_TYPE, timeline
 from constants_manager import ConstantsManager
 from custom_logger import CustomLogger
-from macro_manager import MacroManager
+from datagram_lane import DatagramSender
+from framing import FrameReader, enable_keepalive, encode_frame, send_frame, send_frames, sequenced_frame
+from hotkey_matcher import HotkeyMatcher
+from input_injector import MOUSE_TYPES
+from lazy_module import LazyModule
+from macro_program import MacroCompileError, MacroPrograms, compile_command
+from macro_sync import plan_sync, compact_transactions
+from payload_codec import JSON_CODEC, CODECS, CODEC_PREFERENCE
+from perf_stats import PerfStats
+from session_registry import RESUME_PREFIX, RESUMED_PREFIX, resume_proof
 
 # Getting a logger for the modulw level logging
 module_logger = CustomLogger().get_logger("SocketClientModuleLogger")
 
+# pynput hooks into the OS input stack on import, only load it once a Client is created
+keyboard = LazyModule("pynput.keyboard")
+mouse = LazyModule("pynput.mouse")
+
 # Constants and shared functions
-# Initialize the ConstantsManager with a database URL
+# Initialize the ConstantsManager with a database URL, the DB is only opened on the first get/set
 database_url = "sqlite:///constants.db"  # Using SQLite for this example
 constants_manager = ConstantsManager(database_url)
 
-BUFFER_SIZE = constants_manager.get('BUFFER_SIZE')
-AUTH_SUCCESS = constants_manager.get('AUTH_SUCCESS')
-AUTH_FAILED = constants_manager.get('AUTH_FAILED')
-SHARED_SECRET = constants_manager.get('SHARED_SECRET')
-key_press_times = {}
+# How long connecting to a server or one fan-out target may take before it counts as failed
+CONNECT_TIMEOUT = 5
+# Limit for every read of the handshake, a half-open connection or a server still busy with another client
+# would block the reconnect forever otherwise. Cleared once the handshake is done
+HANDSHAKE_TIMEOUT = 10
+# Reconnect backoff, doubles from the minimum up to the maximum and starts over after a good connection
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10
+# Sent payloads kept until the server acks them. Past this an old mouse move may be dropped, keys and text
+# never are, they are only reported
+MAX_UNACKED = 10000
+# How long request_server_stats waits for the reply
+REPLY_TIMEOUT = 5
+# Frames a writer thread gathers into one write
+MAX_WRITE_BATCH = 256
+# Kernel send buffer of a client connection. Kept small so a backlog waits in our queue, where it is
+# batched and still covered by the replay, instead of sitting in the kernel adding latency
+SEND_BUFFER_SIZE = 64 * 1024
+
 
+class AuthenticationError(Exception):
+    pass
 
-def on_key_press(key):
+
+def key_name_from_event(key):
     try:
         key_name = key.char  # For regular keys
-        module_logger.info(f"it is a char (regular keys)")
-
     except AttributeError:
         key_name = key.name  # For special keys
-        module_logger.info(f"it is a name (special key)")
-
-    logging.info(f"Key pressed: {key_name}")
-    key_press_times[key_name] = time.time()
+    return key_name
 
 
-def keys_pressed_recently(keys, window=0.5):
-    return all(key_press_times.get(key, 0) >= time.time() - window for key in keys)
+def key_code_from_event(key):
+    """Modifier independent identity of the physical key, the virtual key code where pynput reports one"""
+    key_code = getattr(key, "vk", None)
+    if key_code is None:
+        # Special keys are Key enum members wrapping a KeyCode
+        key_code = getattr(getattr(key, "value", None), "vk", None)
+    if key_code is None:
+        key_name = key_name_from_event(key)
+        key_code = key_name.lower() if key_name else key_name
+    return key_code
 
 
 def hash_challenge(challenge):
-    return hashlib.sha256((challenge + SHARED_SECRET).encode()).hexdigest()
+    return hashlib.sha256((challenge + constants_manager.get('SHARED_SECRET')).encode()).hexdigest()
+
+
+def authenticate_connection(sock, reader):
+    challenge = reader.read_frame()
+    if challenge is None:
+        return False
+    response = hash_challenge(challenge.decode())
+    send_frame(sock, response)
+    auth_status = reader.read_frame()
+    return auth_status is not None and auth_status.decode() == constants_manager.get('AUTH_SUCCESS')
+
+
+def negotiate_connection_codec(sock, reader):
+    # The offer itself still goes out as JSON, the server answers with the codec both sides use from now on
+    send_frame(sock, JSON_CODEC.encode({"type": "codec", "data": CODEC_PREFERENCE}))
+    reply = reader.read_frame()
+    if reply is None:
+        raise ConnectionError("Connection closed during codec negotiation")
+    return CODECS.get(reply.decode(), JSON_CODEC)
+
+
+def sync_connection(sock, reader, codec, db_manager):
+    send_frame(sock, codec.encode({"type": "SYNC_HELLO", "data": {"db_id": db_manager.get_db_id()}}))
+    reply = reader.read_frame()
+    if reply is None:
+        raise ConnectionError("Connection closed during macro sync")
+    state = codec.decode(reply)
+    payload = plan_sync(db_manager, state["data"])
+    if payload is not None:
+        send_frame(sock, codec.encode(payload))
+
+
+def handshake(sock, reader, db_manager=None):
+    """
+    Everything a fresh connection goes through before macros flow: challenge/response, codec negotiation
+    and, with a db_manager, the macro sync. Returns the negotiated codec, None if authentication failed.
+    """
+    if not authenticate_connection(sock, reader):
+        return None
+    codec = negotiate_connection_codec(sock, reader)
+    if db_manager is not None:
+        sync_connection(sock, reader, codec, db_manager)
+    return codec
+
+
+def tune_socket(sock):
+    # Every frame is a keystroke someone is waiting for, don't let Nagle hold it back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    # A silently dropped connection has to fail so the client reconnects
+    enable_keepalive(sock)
+
+
+def open_session(sock, reader, codec):
+    """Ask the server for a resumable session, returns (session id, token, datagram port or None)"""
+    send_frame(sock, codec.encode({"type": "hello"}))
+    reply = reader.read_frame()
+    if reply is None:
+        raise ConnectionError("Connection closed while opening a session")
+    data = codec.decode(reply)["data"]
+    return data["session"], data["token"], data.get("datagram_port")
+
+
+def resume_connection(sock, reader, session_id, token):
+    """Answer the challenge with a resume proof, returns the last sequence the server processed, None if refused"""
+    challenge = reader.read_frame()
+    if challenge is None:
+        return None
+    send_frame(sock, f"{RESUME_PREFIX}{session_id}:{resume_proof(challenge.decode(), token)}")
+    reply = reader.read_frame()
+    if reply is None or not reply.startswith(RESUMED_PREFIX.encode()):
+        return None
+    return int(reply[len(RESUMED_PREFIX):])
+
+
+class MouseDeltaAccumulator:
+    """Adds up mouse motion between ticks so it can be sent as one relative move per tick"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_position = None
+        self.dx = 0
+        self.dy = 0
+        self.events = 0
+
+    def on_move(self, x, y):
+        with self.lock:
+            if self.last_position is not None:
+                self.dx += x - self.last_position[0]
+                self.dy += y - self.last_position[1]
+            self.last_position = (x, y)
+            self.events += 1
+
+    def take(self):
+        """Returns the whole pixels moved since the last call, sub pixel remainders carry over"""
+        with self.lock:
+            dx, dy = int(self.dx), int(self.dy)
+            self.dx -= dx
+            self.dy -= dy
+        return dx, dy
 
 
 class Client:
-    def __init__(self, host, port, db_manager):
+    def __init__(self, host, port, db_manager, stream_mouse=False, mouse_tick_rate=None, datagrams=False):
         self.logger = CustomLogger().get_logger("ClientClassLogger")
+        # Per key/per payload messages go through this one so a burst of input can't flood the log
+        self.event_logger = CustomLogger().get_sampled_logger("ClientClassLogger")
         self.host = host
         self.port = port
         self.client_socket = None
+        self.reader = None
+        self.codec = JSON_CODEC
         # self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # self.client_socket.connect((host, port))
-        # self.db_manager = db_manager
-        self.listener = keyboard.Listener(on_press=on_key_press)
+        self.db_manager = db_manager
+        self.matcher = HotkeyMatcher()
+        self.programs = MacroPrograms()
+        # Set once the macro sync ran, then macros are sent as one run_macro the server expands itself.
+        # Digests the server did not know are remembered and those macros go step by step again
+        self.remote_macros = False
+        self.macro_misses = set()
+        self.fired_hotkeys = queue.Queue()
+        self.listener = keyboard.Listener(on_press=self.on_key_press, on_release=self.on_key_release)
         self.transaction_queue = []
+        # Held by whoever writes to the socket, the writer thread or a (re)connect
+        self.send_lock = threading.Lock()
+        # Only one thread at a time may wait for a reply frame
+        self.recv_lock = threading.Lock()
+        self.stats = PerfStats("client")
+        # Times macros the server can't schedule itself (WAIT: together with EXIT:), started on first use
+        self.scheduler = ActionScheduler(self.send_step, stats=self.stats, name="ClientScheduler")
+
+        self.stream_mouse = stream_mouse
+        self.mouse_tick_rate = mouse_tick_rate or constants_manager.get('MOUSE_TICK_RATE')
+        self.mouse_accumulator = MouseDeltaAccumulator()
+        self.mouse_listener = None
+        self.mouse_thread = None
+        self.mouse_stop = threading.Event()
+        # Set while a connection is authenticated and synced and macros are being sent
+        self.ready = threading.Event()
+        self.closing = threading.Event()
+        self.macro_thread = None
+        self.writer_thread = None
+        self.wake_writer = threading.Event()
+
+        # Resumable session, (session id, token) once the server opened one
+        self.session = None
+        self.connected = False
+        self.next_sequence = 1
+        # (sequence, payload, queued at, pre-encoded bytes per codec or None) not acked yet. It is also the
+        # send queue: the writer sends everything past sent_sequence and a reconnect just moves sent_sequence
+        # back to what the server processed
+        self.unacked = deque()
+        self.sent_sequence = 0
+        self.ack_lock = threading.Lock()
+        # Replies (stats) picked up by the receive loop
+        self.replies = queue.Queue()
+        # Mouse moves go over UDP when asked for and the server offers it, see datagram_lane.py
+        self.datagrams = datagrams
+        self.datagram_sender = None
+        constants_manager.subscribe('BUFFER_SIZE', self.on_buffer_size_changed)
+        constants_manager.subscribe('MOUSE_TICK_RATE', self.on_mouse_tick_rate_changed)
 
     def start_client_services(self):
         logging.info("Starting main client loop...")
+        self.matcher.reset()
+        self.listener.start()
+        self.logger.info("Keyboard listener started")
+        # Macros keep running while the connection is down, their payloads wait in unacked for the replay
+        self.macro_thread = threading.Thread(target=self.main_client_loop, name="MacroLoop", daemon=True)
+        self.macro_thread.start()
+        self.writer_thread = threading.Thread(target=self.writer_loop, name="ClientWriter", daemon=True)
+        self.writer_thread.start()
+        delay = RECONNECT_MIN_DELAY
         try:
-            self.listener.start()
-            self.logger.info("Keyboard listener started")
-            with socket.create_connection((self.host, self.port)) as self.client_socket:
-                self.logger.info("Client socket created successfully, authenticating...")
-                if not self.authenticate_server_with_client():
+            while not self.closing.is_set():
+                try:
+                    self.run_connection()
+                    delay = RECONNECT_MIN_DELAY
+                except AuthenticationError:
                     self.logger.error("Authentication failed :(")
-                    return
-                self.logger.info("Authentication Success!")
-                self.main_client_loop()
-        except Exception as e:
-            self.logger.error(f"Error in sending data to slave: {e}")
+                    break
+                except Exception as e:
+                    self.logger.error(f"Error in sending data to slave: {e}")
+                if self.closing.is_set():
+                    break
+                wait = delay * random.uniform(0.5, 1.0)
+                self.logger.info(f"Reconnecting to {self.host}:{self.port} in {wait:.1f}s, "
+                                 f"{len(self.unacked)} payloads waiting for replay")
+                if self.closing.wait(wait):
+                    break
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                self.stats.increment("reconnects")
+        finally:
+            self.ready.clear()
+            self.stop_mouse_stream()
+            self.fired_hotkeys.put(None)
+            self.wake_writer.set()
+
+    def connect(self):
+        self.client_socket = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        self.client_socket.settimeout(HANDSHAKE_TIMEOUT)
+        tune_socket(self.client_socket)
+        self.reader = FrameReader(self.client_socket, constants_manager.get('BUFFER_SIZE'), stats=self.stats)
+        return self.client_socket
+
+    def run_connection(self):
+        """One connection from connect to disconnect: resume or handshake, replay, then receive until it drops"""
+        sock = self.connect()
+        try:
+            acked = None
+            if self.session is not None:
+                acked = resume_connection(sock, self.reader, *self.session)
+                if acked is None:
+                    # The server forgot the session (restarted?), it closes this connection after refusing
+                    self.logger.warning(f"Session {self.session[0]} could not be resumed, doing the full handshake")
+                    self.session = None
+                    sock.close()
+                    sock = self.connect()
+            if acked is not None:
+                self.logger.info(f"Resumed session {self.session[0]}, server processed up to {acked}")
+                self.stats.increment("resumed")
+                self.on_ack(acked)
+            else:
+                acked = 0
+                self.logger.info("Client socket created successfully, authenticating...")
+                codec = handshake(sock, self.reader, self.db_manager)
+                if codec is None:
+                    raise AuthenticationError()
+                self.logger.info(f"Authentication Success! Using {codec.name} payload codec")
+                self.codec = codec
+                self.remote_macros = self.db_manager is not None
+                session_id, token, datagram_port = open_session(sock, self.reader, codec)
+                self.session = (session_id, token)
+                self.open_datagram_lane(datagram_port)
+            # The writer and receiver threads block on the socket from here on
+            sock.settimeout(None)
+            self.replay(acked)
+            if self.stream_mouse and (self.mouse_thread is None or not self.mouse_thread.is_alive()):
+                self.start_mouse_stream()
+            self.ready.set()
+            self.receive_loop()
+        finally:
+            self.ready.clear()
+            # Unblocks a writer stuck on a dead connection before taking its lock
+            self.shutdown_socket()
+            with self.send_lock:
+                self.connected = False
+            sock.close()
+
+    def open_datagram_lane(self, port):
+        # A new session means a new MAC key, the sender of the old one is useless
+        if self.datagram_sender is not None:
+            self.datagram_sender.close()
+            self.datagram_sender = None
+        if not self.datagrams:
+            return
+        if port is None:
+            self.logger.warning("Server has no datagram lane, mouse moves stay on TCP")
+            return
+        self.datagram_sender = DatagramSender((self.host, port), *self.session, self.codec)
+        self.logger.info(f"Sending mouse moves as datagrams to {self.host}:{port}")
+
+    def replay(self, acked):
+        """Let the writer (re)send everything the server has not processed, acked is its last sequence"""
+        with self.send_lock:
+            self.sent_sequence = acked
+            self.connected = True
+        with self.ack_lock:
+            pending = len(self.unacked)
+        if pending:
+            self.logger.info(f"Sending {pending} payloads the server has not processed yet")
+            self.stats.increment("replayed", pending)
+        self.wake_writer.set()
+
+    def writer_loop(self):
+        """Does every socket write of the connection, so sending never blocks the matcher or the mouse ticker"""
+        while True:
+            self.wake_writer.wait()
+            self.wake_writer.clear()
+            if self.closing.is_set():
+                break
+            while self.flush():
+                pass
+        self.logger.info("Client writer stopped")
+
+    def flush(self):
+        """Write the payloads waiting past sent_sequence as one batch, returns False if there was nothing to do"""
+        with self.send_lock:
+            if not self.connected:
+                return False
+            with self.ack_lock:
+                if not self.unacked or self.unacked[-1][0] <= self.sent_sequence:
+                    return False
+                first = max(self.sent_sequence + 1 - self.unacked[0][0], 0)
+                batch = list(islice(self.unacked, first, first + MAX_WRITE_BATCH))
+            start = time.perf_counter_ns()
+            codec = self.codec
+            buffers = []
+            for sequence, payload, _, encoded in batch:
+                message = encoded[codec.name] if encoded is not None else codec.encode(payload)
+                buffers.extend(sequenced_frame(sequence, message))
+            encoded = self.stats.record_since("encode", start)
+            try:
+                send_frames(self.client_socket, buffers)
+            except OSError as e:
+                self.connected = False
+                self.logger.warning(f"Send failed, {len(batch)} payloads wait for the reconnect: {e}")
+                self.shutdown_socket()
+                return False
+            sent = self.stats.record_since("send", encoded)
+            self.sent_sequence = batch[-1][0]
+        for _, _, queued_at, _ in batch:
+            self.stats.record("deliver", sent - queued_at)
+        self.stats.increment("batches")
+        self.stats.increment("frames_sent", len(batch))
+        self.stats.increment("bytes_sent", sum(len(buffer) for buffer in buffers))
+        return True
+
+    def receive_loop(self):
+        """Reads everything the server sends while connected: acks trim the replay queue, replies are handed over"""
+        while not self.closing.is_set():
+            frames = self.reader.read_frames()
+            if frames is None:
+                self.logger.warning("Connection lost with server")
+                return
+            for frame in frames:
+                payload = self.codec.decode(frame)
+                payload_type = payload.get("type")
+                if payload_type == "ack":
+                    self.on_ack(payload["data"])
+                elif payload_type == "stats":
+                    self.replies.put(payload["data"])
+                elif payload_type == "macro_miss":
+                    self.on_macro_miss(payload["data"])
+                else:
+                    self.logger.warning(f"Unexpected {payload_type} payload from server")
+
+    def on_macro_miss(self, data):
+        """The server's copy of the macro differs, send the steps it could not expand"""
+        self.macro_misses.add(data["digest"])
+        program = self.programs.get(data["hotkey"])
+        if program is None or program.digest != data["digest"]:
+            self.logger.warning(f"Macro {data['hotkey']} changed before the server's miss came back, not resent")
+            return
+        self.logger.warning(f"Server does not have macro {data['hotkey']} in sync, sending its steps")
+        self.send_steps(program)
+
+    def send_steps(self, program):
+        if program.sequence is not None:
+            # One payload, the server runs the waits on its scheduler
+            self.send_in_order([program.sequence])
+        elif program.timed:
+            entries, duration = timeline(program.steps, payload=lambda step: step.payload)
+            self.scheduler.start()
+            self.scheduler.schedule(entries, duration)
+        else:
+            self.send_in_order(program.steps)
+
+    def send_in_order(self, steps):
+        """Send steps now, or after the macro the local scheduler is still timing so they don't land inside it"""
+        if self.scheduler.busy():
+            self.scheduler.schedule([(0.0, step) for step in steps])
+        else:
+            for step in steps:
+                self.send_step(step)
+
+    def send_step(self, step):
+        self.event_logger.info("Processing command: %s", step.command)
+        self.send_data(step.payload, step.encoded)
+
+    def on_ack(self, sequence):
+        with self.ack_lock:
+            while self.unacked and self.unacked[0][0] <= sequence:
+                self.unacked.popleft()
+
+    def on_buffer_size_changed(self, name, value):
+        if self.reader is not None:
+            self.reader.resize(value)
+
+    def on_mouse_tick_rate_changed(self, name, value):
+        # mouse_stream_loop picks the new rate up on its next tick
+        self.logger.info(f"Mouse tick rate changed from {self.mouse_tick_rate} to {value} Hz")
+        self.mouse_tick_rate = value
+
+    def start_mouse_stream(self):
+        self.mouse_stop.clear()
+        self.mouse_listener = mouse.Listener(on_move=self.mouse_accumulator.on_move)
+        self.mouse_listener.start()
+        self.mouse_thread = threading.Thread(target=self.mouse_stream_loop, name="MouseStreamer", daemon=True)
+        self.mouse_thread.start()
+        self.logger.info(f"Mouse streaming started at {self.mouse_tick_rate} Hz")
+
+    def stop_mouse_stream(self):
+        self.mouse_stop.set()
+        if self.mouse_listener is not None:
+            self.mouse_listener.stop()
+            self.mouse_listener = None
+
+    def mouse_stream_loop(self):
+        next_tick = time.monotonic()
+        while not self.mouse_stop.is_set():
+            next_tick += 1.0 / self.mouse_tick_rate
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.mouse_stop.wait(delay)
+            else:
+                # Fell behind, skip the missed ticks instead of sending a burst to catch up
+                next_tick = time.monotonic()
+            if not self.connected:
+                # The motion adds up in the accumulator and goes out as one move after the reconnect, instead
+                # of a tick's worth of queued moves each
+                continue
+            dx, dy = self.mouse_accumulator.take()
+            if dx or dy:
+                try:
+                    self.send_data({"type": "mouse_move_rel", "data": {"dx": dx, "dy": dy}})
+                except OSError as e:
+                    self.logger.error("Stopping mouse stream, could not send movement: %s", e)
+                    break
+
+    def on_key_press(self, key):
+        start = time.perf_counter_ns()
+        key_name = key_name_from_event(key)
+        self.event_logger.debug("Key pressed: %s", key_name)
+        hotkey = self.matcher.on_press(key_name, key_code=key_code_from_event(key))
+        self.stats.record_since("match", start)
+        if hotkey is not None:
+            self.fired_hotkeys.put(hotkey)
+
+    def on_key_release(self, key):
+        self.matcher.on_release(key_name_from_event(key), key_code=key_code_from_event(key))
 
     def main_client_loop(self):
+        # Blocks until the listener reports a completed chord, so an idle client uses no CPU
         while True:
-            for hotkey, commands in MacroManager.get_macros().copy().items():
-                if self.should_execute_macro(hotkey):
-                    for command in commands:
-                        self.process_and_send_command(command)
-
-                    time.sleep(0.5)  # Delay to avoid rapid firing
-
-    def should_execute_macro(self, hotkey):
-        required_keys = set(hotkey.split('+'))
-        if keys_pressed_recently(required_keys):
-            for key in required_keys:
-                key_press_times.pop(key, None)
-            self.logger.info(f"Will execute macro: {hotkey}")
-            return True
-        return False
+            hotkey = self.fired_hotkeys.get()
+            if hotkey is None:
+                # close() or a failed fan-out target asked the loop to stop
+                break
+            program = self.programs.get(hotkey)
+            if program is None:
+                self.logger.warning(f"Macro {hotkey} was removed before it could run")
+                continue
+            start = time.perf_counter_ns()
+            if self.remote_macros and program.run is not None and program.digest not in self.macro_misses:
+                self.send_in_order([program.run])
+            else:
+                self.send_steps(program)
+            self.stats.record_since("macro", start)
 
     def process_and_send_command(self, user_input):
         try:
-            self.logger.info(f"Processing command: {user_input}")
-
-            if user_input.startswith("EXIT:"):
-                payload = {"type": "exit"}
-            elif user_input.startswith("TEXT:"):
-                text = user_input[len("TEXT:"):].strip()
-                payload = {"type": "text", "data": text}
-            elif user_input.startswith("KEYS:"):
-                keys = user_input[len("KEYS:"):].strip().split('+')
-                payload = {"type": "keys", "data": keys}
-            else:
-                self.logger.error("Invalid command. Please use TEXT:, KEYS:, or EXIT: as a prefix.")
+            self.event_logger.info("Processing command: %s", user_input)
+
+            try:
+                payload = compile_command(user_input)
+            except MacroCompileError as e:
+                self.logger.error(str(e))
+                return
+            if payload["type"] == WAIT_TYPE:
+                self.logger.error("WAIT: only works inside a macro")
                 return
 
             self.send_data(payload)
         except Exception as e:
-            self.logger.error(f"Error processing command for input {user_input}: {e}")
+            self.logger.error("Error processing command for input %s: %s", user_input, e)
 
     def create_db_sync_payload_and_send(self, transactions):
-        payload = {"type": "SYNC_MACROS", "data": transactions}
+        revisions = [transaction['revision'] for transaction in transactions if transaction.get('revision')]
+        compacted, stats = compact_transactions(transactions)
+        self.logger.info(f"Compacted {stats['input']} transactions to {stats['output']}, "
+                         f"removed {stats['removed']} operations")
+        payload = {"type": "SYNC_MACROS", "data": compacted}
+        if self.db_manager is not None and revisions and len(revisions) == len(transactions):
+            payload["db_id"] = self.db_manager.get_db_id()
+            payload["base_revision"] = min(revisions) - 1
+            payload["revision"] = max(revisions)
         self.logger.info(f"We will be sending over the payload: {payload}")
         self.send_data(data=payload)
 
-    def authenticate_server_with_client(self):
-        challenge = self.client_socket.recv(BUFFER_SIZE).decode()
-        response = hash_challenge(challenge)
-        self.client_socket.sendall(response.encode())
-        auth_status = self.client_socket.recv(BUFFER_SIZE).decode()
-        return auth_status == AUTH_SUCCESS
+    def send_data(self, data, encoded=None):
+        """
+        Queue a payload under the next sequence number for the writer thread, never blocks on the network.
+        encoded maps codec names to the payload's bytes when they are cached, see macro_program.py
+        """
+        self.event_logger.info("Sending message %s to server", data)
+        sender = self.datagram_sender
+        if sender is not None and self.connected and data.get("type") in MOUSE_TYPES and sender.send(data):
+            self.stats.increment("datagrams_sent")
+            return
+        with self.ack_lock:
+            self.unacked.append((self.next_sequence, data, time.perf_counter_ns(), encoded))
+            self.next_sequence += 1
+            if len(self.unacked) > MAX_UNACKED:
+                if self.unacked[0][1].get("type") in MOUSE_TYPES:
+                    # A stale cursor move is the only thing that may be lost
+                    self.unacked.popleft()
+                    self.stats.increment("unacked_dropped")
+                else:
+                    self.stats.increment("unacked_over_limit")
+                    self.event_logger.error("%d payloads wait for the server, more than the %d expected, keys and "
+                                            "text are kept for the replay", len(self.unacked), MAX_UNACKED)
+        self.wake_writer.set()
+
+    def request_server_stats(self):
+        """Ask the server for its timing stats, returns None if the connection is not up or no reply came"""
+        if not self.ready.is_set():
+            return None
+        with self.recv_lock:
+            # Drop replies to earlier requests that timed out or were replayed
+            while not self.replies.empty():
+                self.replies.get_nowait()
+            self.send_data({"type": "stats"})
+            try:
+                return self.replies.get(timeout=REPLY_TIMEOUT)
+            except queue.Empty:
+                self.logger.warning(f"No stats reply from the server within {REPLY_TIMEOUT}s")
+                return None
+
+    def shutdown_socket(self):
+        # Wakes the receive loop, which then reconnects (or stops when closing)
+        if self.client_socket is not None:
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        constants_manager.unsubscribe('BUFFER_SIZE', self.on_buffer_size_changed)
+        constants_manager.unsubscribe('MOUSE_TICK_RATE', self.on_mouse_tick_rate_changed)
+        self.closing.set()
+        self.wake_writer.set()
+        self.listener.stop()
+        self.scheduler.close()
+        self.stop_mouse_stream()
+        self.fired_hotkeys.put(None)
+        self.shutdown_socket()
+        if self.client_socket is not None:
+            self.client_socket.close()
+        if self.datagram_sender is not None:
+            self.datagram_sender.close()
+
+
+class FanoutTarget:
+    """One slave of a FanoutClient with its own connection, send queue and writer thread"""
+
+    def __init__(self, host, port, max_queue_size):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.sock = None
+        self.reader = None
+        self.codec = JSON_CODEC
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self.connected = False
+        self.last_error = None
+        self.recv_lock = threading.Lock()
+        # Stats replies still owed for requests that timed out, they arrive ahead of the next one's
+        self.late_replies = 0
+        self.stats = PerfStats(self.name)
+
+    def summary(self):
+        snapshot = self.stats.snapshot()
+        return {
+            "connected": self.connected,
+            "codec": self.codec.name,
+            "queued": self.queue.qsize(),
+            "last_error": self.last_error,
+            "counters": snapshot["counters"],
+            "stages": snapshot["stages"],
+        }
+
+
+class FanoutClient(Client):
+    """
+    Master that drives several slaves at once.
+
+    Every target gets its own authenticated connection, bounded send queue and writer thread. send_data
+    encodes a payload once per codec and only queues it, so a slow or dead slave never holds up the
+    others or the matcher. Per target stats record the time from queueing to the frame being written
+    ("deliver") plus sent/dropped/error counters. With fail_fast the client stops as soon as any target
+    fails, otherwise it keeps going while at least one target is connected.
+    """
+
+    def __init__(self, hosts, port, db_manager, fail_fast=False, stream_mouse=False, mouse_tick_rate=None,
+                 max_queue_size=1024):
+        super().__init__(hosts[0], port, db_manager, stream_mouse=stream_mouse, mouse_tick_rate=mouse_tick_rate)
+        self.logger = CustomLogger().get_logger("FanoutClientClassLogger")
+        self.targets = [FanoutTarget(host, port, max_queue_size) for host in hosts]
+        self.fail_fast = fail_fast
+
+    def start_client_services(self):
+        logging.info(f"Starting fan-out client loop for {len(self.targets)} targets...")
+        try:
+            self.matcher.reset()
+            self.listener.start()
+            self.logger.info("Keyboard listener started")
+            connectors = [threading.Thread(target=self.connect_target, args=(target,), name=f"Connect {target.name}")
+                          for target in self.targets]
+            for connector in connectors:
+                connector.start()
+            for connector in connectors:
+                connector.join()
+
+            connected = [target for target in self.targets if target.connected]
+            if not connected or (self.fail_fast and len(connected) < len(self.targets)):
+                self.logger.error(f"Only {len(connected)} of {len(self.targets)} targets connected, stopping")
+                return
+            self.logger.info(f"Connected to {len(connected)} of {len(self.targets)} targets")
+            for target in connected:
+                target.thread = threading.Thread(target=self.target_writer, args=(target,),
+                                                 name=f"Writer {target.name}", daemon=True)
+                target.thread.start()
+            if self.stream_mouse:
+                self.start_mouse_stream()
+            self.ready.set()
+            self.main_client_loop()
+        except Exception as e:
+            self.logger.error(f"Error in fan-out client: {e}")
+        finally:
+            self.ready.clear()
+            self.stop_mouse_stream()
+            self.close_targets()
+
+    def connect_target(self, target):
+        sock = None
+        try:
+            sock = socket.create_connection((target.host, target.port), timeout=CONNECT_TIMEOUT)
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            tune_socket(sock)
+            reader = FrameReader(sock, constants_manager.get('BUFFER_SIZE'), stats=target.stats)
+            codec = handshake(sock, reader, self.db_manager)
+            if codec is None:
+                raise ConnectionError("authentication failed")
+            sock.settimeout(None)
+            target.sock, target.reader, target.codec = sock, reader, codec
+            target.connected = True
+            self.logger.info(f"Connected to {target.name} using the {codec.name} codec")
+        except Exception as e:
+            if sock is not None:
+                sock.close()
+            self.target_failed(target, e)
+
+    def target_writer(self, target):
+        stop = False
+        while not stop:
+            batch = [target.queue.get()]
+            # Everything queued meanwhile goes out in the same write
+            while len(batch) < MAX_WRITE_BATCH:
+                try:
+                    batch.append(target.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                batch = batch[:batch.index(None)]
+            if not batch:
+                break
+            try:
+                send_frames(target.sock, [frame for frame, _ in batch])
+            except OSError as e:
+                if target.connected:
+                    self.target_failed(target, e)
+                break
+            sent = time.perf_counter_ns()
+            for frame, queued_at in batch:
+                target.stats.record("deliver", sent - queued_at)
+            target.stats.increment("sent", len(batch))
+            target.stats.increment("batches")
+            target.stats.increment("bytes_sent", sum(len(frame) for frame, _ in batch))
+
+    def target_failed(self, target, error):
+        target.connected = False
+        target.last_error = str(error)
+        target.stats.increment("errors")
+        self.logger.error(f"Target {target.name} failed: {error}")
+        # While connecting, start_client_services decides whether enough targets made it
+        if self.ready.is_set() and (self.fail_fast or not any(other.connected for other in self.targets)):
+            self.stop()
+
+    def stop(self):
+        # Wakes main_client_loop, start_client_services then closes every target
+        self.fired_hotkeys.put(None)
+
+    def send_data(self, data, encoded=None):
+        start = time.perf_counter_ns()
+        frames = {}
+        for target in self.targets:
+            if not target.connected:
+                continue
+            frame = frames.get(target.codec.name)
+            if frame is None:
+                message = encoded[target.codec.name] if encoded is not None else target.codec.encode(data)
+                frame = frames[target.codec.name] = encode_frame(message)
+            try:
+                target.queue.put_nowait((frame, start))
+            except queue.Full:
+                target.stats.increment("dropped")
+                self.event_logger.warning("Send queue of %s is full, dropped a frame", target.name)
+                if self.fail_fast:
+                    self.target_failed(target, "send queue full")
+        self.stats.record_since("encode", start)
+
+    def request_server_stats(self):
+        """Timing stats of every connected target, keyed by target name"""
+        if not self.ready.is_set():
+            return None
+        results = {}
+        for target in self.targets:
+            if not target.connected:
+                results[target.name] = {"error": target.last_error}
+                continue
+            with target.recv_lock:
+                target.queue.put((encode_frame(target.codec.encode({"type": "stats"})), time.perf_counter_ns()))
+                try:
+                    reply = self.read_stats_reply(target)
+                except TimeoutError:
+                    # One stalled target must not hold up the others
+                    target.late_replies += 1
+                    self.logger.warning(f"No stats reply from {target.name} within {REPLY_TIMEOUT}s")
+                    results[target.name] = {"error": f"no reply within {REPLY_TIMEOUT}s"}
+                    continue
+            results[target.name] = target.codec.decode(reply)["data"] if reply is not None else {"error": "closed"}
+        return results
+
+    @staticmethod
+    def read_stats_reply(target):
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while True:
+            reply = target.reader.read_frame(timeout=max(0.0, deadline - time.monotonic()))
+            if reply is None or not target.late_replies:
+                return reply
+            # Answer to an earlier request that timed out
+            target.late_replies -= 1
+
+    def target_stats(self):
+        return {target.name: target.summary() for target in self.targets}
+
+    def on_buffer_size_changed(self, name, value):
+        for target in self.targets:
+            if target.reader is not None:
+                target.reader.resize(value)
 
-    def send_data(self, data):
-        message = json.dumps(data)
-        self.logger.info(f"Sending message {message} to server")
-        self.client_socket.sendall(message.encode('utf-8'))
+    def close_targets(self):
+        for target in self.targets:
+            target.connected = False
+            if target.sock is not None:
+                target.sock.close()
+            try:
+                target.queue.put_nowait(None)
+            except queue.Full:
+                pass
 
     def close(self):
-        self.client_socket.close()
+        constants_manager.unsubscribe('BUFFER_SIZE', self.on_buffer_size_changed)
+        constants_manager.unsubscribe('MOUSE_TICK_RATE', self.on_mouse_tick_rate_changed)
+        self.listener.stop()
+        self.stop_mouse_stream()
+        self.scheduler.close()
+        self.stop()
+        self.close_targets()
@@ -2,27 +2,38 @@ import hashlib
 import logging
 import random
 import socket
-import json
-
-import pyautogui
+import threading
+import time
 
+from action_scheduler import ActionScheduler, WAIT_TYPE, timeline
 from constants_manager import ConstantsManager
 from custom_logger import CustomLogger
+from datagram_lane import DatagramReceiver
+from framing import FrameReader, enable_keepalive, send_frame, split_sequence
+from input_injector import InputInjector, MOUSE_TYPES
+from lazy_module import LazyModule
+from macro_program import MacroTable
+from macro_sync import apply_sync_macros, apply_snapshot, build_sync_state
+from payload_codec import JSON_CODEC, choose_codec
+from perf_stats import PerfStats
+from session_registry import SessionRegistry, RESUME_PREFIX, RESUMED_PREFIX
 
 # Getting a logger for the modulw level logging
 module_logger = CustomLogger().get_logger("SocketServerModuleLogger")
 
+# Imported on the first injection, a server that never injects never loads it
+pyautogui = LazyModule("pyautogui")
+
 # Constants and shared functions
-# Initialize the ConstantsManager with a database URL
+# Initialize the ConstantsManager with a database URL, the DB is only opened on the first get/set
 database_url = "sqlite:///constants.db"  # Using SQLite for this example
 constants_manager = ConstantsManager(database_url)
 
-HOST = constants_manager.get('HOST')
-PORT = constants_manager.get('PORT')
-SHARED_SECRET = constants_manager.get('SHARED_SECRET')
-BUFFER_SIZE = constants_manager.get('BUFFER_SIZE')
-AUTH_SUCCESS = constants_manager.get('AUTH_SUCCESS')
-AUTH_FAILED = constants_manager.get('AUTH_FAILED')
+# A client that does not answer the challenge in time is dropped instead of holding a session open
+AUTH_TIMEOUT = 10
+
+# Payload types that end up as synthetic input on this machine
+INJECTION_TYPES = ("text", "keys", "key_down", "key_up", "mouse_move", "mouse_move_rel")
 
 
 def generate_challenge():
@@ -33,33 +44,115 @@ def validate_response(response, challenge):
     return response == hash_challenge(challenge)
 
 
+def is_key_up(payload):
+    """Scheduled steps still sent on shutdown, a key pressed by a timed macro must not stay held"""
+    return payload.get("type") == "key_up"
+
+
 def hash_challenge(challenge):
-    return hashlib.sha256((challenge + SHARED_SECRET).encode()).hexdigest()
+    return hashlib.sha256((challenge + constants_manager.get('SHARED_SECRET')).encode()).hexdigest()
 
 
 class Server:
-    def __init__(self, host, port, db_manager):
+    def __init__(self, host, port, db_manager, datagrams=False):
         self.logger = CustomLogger().get_logger("ServerClassLogger")
+        self.event_logger = CustomLogger().get_sampled_logger("ServerClassLogger")
+        self.host = host
+        self.port = port
         self.server_socket = None
+        # Codec of the current connection, every connection starts with JSON until the client negotiates
+        self.codec = JSON_CODEC
         # self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # self.server_socket.bind((host, port))
         # self.server_socket.listen(5)
         self.db_manager = db_manager
+        self.stats = PerfStats("server")
+        self.injector = InputInjector(self.inject_payload, stats=self.stats)
+        # Timed macros (WAIT: steps) are handed to the injector by the scheduler at their due time
+        self.scheduler = ActionScheduler(self.injector.submit, stats=self.stats, name="ServerScheduler")
+        self.reader = None
+        # Socket of the client being served and the lock its handler holds while serving it
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.serving = threading.Lock()
+        # Sessions outlive connections so a reconnecting client can resume, see session_registry.py
+        self.session_registry = SessionRegistry()
+        self.session = None
+        # Programs run_macro payloads are expanded from, kept current by observing the DB
+        self.macro_table = MacroTable(db_manager) if db_manager is not None else None
+        # Optional UDP lane for mouse moves, see datagram_lane.py
+        self.datagrams = datagrams
+        self.datagram_receiver = None
+        constants_manager.subscribe('BUFFER_SIZE', self.on_buffer_size_changed)
 
     def start(self):
+        self.injector.start()
+        self.scheduler.start()
         try:
+            self.start_datagram_lane()
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self.server_socket:
-                self.server_socket.bind((HOST, PORT))
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.server_socket.bind((self.host, self.port))
                 self.server_socket.listen()
                 self.logger.info("Server started and waiting for connections...")
 
-                client, addr = self.server_socket.accept()
-                self.logger.info(f"Connection from {addr}")
-                self.handle_connection(client, addr)
+                # One client at a time, but keep accepting so a dropped client can reconnect and resume
+                while True:
+                    try:
+                        client, addr = self.server_socket.accept()
+                    except OSError:
+                        self.logger.info("Server socket closed, no longer accepting connections")
+                        break
+                    self.logger.info(f"Connection from {addr}")
+                    threading.Thread(target=self.connection_thread, args=(client, addr), name=f"Connection-{addr}",
+                                     daemon=True).start()
 
         except Exception as e:
             self.logger.error(f"Error in listen_for_data: {e}")
 
+    def start_datagram_lane(self):
+        if not self.datagrams:
+            return
+        self.datagram_receiver = DatagramReceiver(self.host, self.port, self.session_registry,
+                                                  self.submit_datagram, self.stats)
+        self.datagram_receiver.start()
+
+    def submit_datagram(self, payload):
+        # Stale cursor updates are worthless, drop instead of waiting when injection falls behind
+        if not self.injector.try_submit(payload):
+            self.stats.increment("datagram_dropped")
+
+    def expand_macro(self, data):
+        """Payloads of a run_macro from the local macro table, None if it does not have that exact macro"""
+        payloads = self.macro_table.expand(data["hotkey"], data["digest"]) if self.macro_table is not None else None
+        if payloads is None:
+            self.stats.increment("macro_misses")
+            self.logger.warning(f"Macro {data['hotkey']} is not in sync, asking the client for its steps")
+        else:
+            self.stats.increment("macros_expanded")
+        return payloads
+
+    def schedule_sequence(self, payloads, lane):
+        """Run timed steps on the connection's scheduler lane, anything that is not input or a wait is left out"""
+        steps = [step for step in payloads if step.get("type") in INJECTION_TYPES or step.get("type") == WAIT_TYPE]
+        if len(steps) != len(payloads):
+            self.logger.warning(f"Left {len(payloads) - len(steps)} steps that can't be scheduled out of a sequence")
+        entries, duration = timeline(steps)
+        self.scheduler.schedule(entries, duration, lane=lane)
+
+    def queue_behind_sequence(self, payloads, lane):
+        """Schedule untimed payloads after the lane's running timed sequence, False if there is none"""
+        if not self.scheduler.busy(lane):
+            return False
+        self.scheduler.schedule([(0.0, payload) for payload in payloads], lane=lane)
+        return True
+
+    def hello_reply(self, session):
+        data = {"session": session.session_id, "token": session.token}
+        if self.datagram_receiver is not None:
+            data["datagram_port"] = self.port
+        return {"type": "hello", "data": data}
+
     # TODO: change this to handle correct data if we want to do it this way
     def handle_data(self, data):
         action = data['action']
@@ -75,51 +168,184 @@ class Server:
 
     def close(self):
         self.logger.info("Closing server socket")
-        self.server_socket.close()
+        constants_manager.unsubscribe('BUFFER_SIZE', self.on_buffer_size_changed)
+        self.scheduler.close(flush=is_key_up)
+        self.injector.close()
+        if self.datagram_receiver is not None:
+            self.datagram_receiver.close()
+        if self.macro_table is not None:
+            self.macro_table.close()
+        if self.server_socket is not None:
+            try:
+                # close() alone does not wake the thread blocked in accept() on Linux
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        self.drop_current_client("Server shutdown")
+
+    def connection_thread(self, client, addr):
+        try:
+            self.handle_connection(client, addr)
+        except Exception as e:
+            self.logger.error(f"Error while serving {addr}: {e}")
 
     def handle_connection(self, client, addr):
         with client:
-            if self.authenticate(client):
-                self.logger.info("Authentication successful")
-                client.sendall(AUTH_SUCCESS.encode())
-                self.main_server_loop(client)
+            enable_keepalive(client)
+            client.settimeout(AUTH_TIMEOUT)
+            reader = FrameReader(client, constants_manager.get('BUFFER_SIZE'), stats=self.stats)
+            authenticated, session = self.authenticate(client, reader)
+            if not authenticated:
+                self.logger.error("Authentication failed")
+                send_frame(client, constants_manager.get('AUTH_FAILED'))
+                return
+            client.settimeout(None)
+            # A client that authenticated again is back, the connection being served is most likely one that
+            # dropped silently. Cut it so its handler stops and this one can take over
+            self.drop_current_client(f"{addr} authenticated")
+            with self.serving:
+                with self.client_lock:
+                    self.client = client
+                self.codec = JSON_CODEC
+                self.session = session
+                self.reader = reader
+                if session is not None:
+                    # Resumed, the codec was negotiated on the first connection of the session
+                    self.codec = session.codec
+                    send_frame(client, f"{RESUMED_PREFIX}{session.last_sequence}")
+                else:
+                    self.logger.info("Authentication successful")
+                    send_frame(client, constants_manager.get('AUTH_SUCCESS'))
+                try:
+                    self.main_server_loop(client, reader)
+                finally:
+                    self.scheduler.release(self.session or client)
+                    with self.client_lock:
+                        if self.client is client:
+                            self.client = None
+
+    def drop_current_client(self, reason):
+        with self.client_lock:
+            current, self.client = self.client, None
+        if current is None:
+            return
+        self.logger.warning(f"Dropping the client served until now: {reason}")
+        try:
+            current.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already closed
+            pass
+
+    def on_buffer_size_changed(self, name, value):
+        if self.reader is not None:
+            self.reader.resize(value)
 
-    def authenticate(self, client):
+    def authenticate(self, client, reader):
+        """(authenticated, the resumed session or None)"""
         challenge = generate_challenge()
-        client.sendall(challenge.encode())
-        response = client.recv(BUFFER_SIZE).decode()
-        return validate_response(response, challenge)
+        send_frame(client, challenge)
+        response = reader.read_frame()
+        if response is None:
+            return False, None
+        response = response.decode()
+        if response.startswith(RESUME_PREFIX):
+            session = self.session_registry.resume(response, challenge)
+            return session is not None, session
+        return validate_response(response, challenge), None
 
-    def main_server_loop(self, client):
+    def main_server_loop(self, client, reader):
         while True:
-            data_received = client.recv(BUFFER_SIZE).decode()
-            if not data_received:
+            frames = reader.read_frames()
+            if frames is None:
                 self.logger.warning("Connection lost with client")
                 break
-            self.process_received_payload(data_received, client)
+            acked = self.session.last_sequence if self.session is not None else 0
+            for frame in frames:
+                self.process_received_frame(frame, client)
+            if self.session is not None and self.session.last_sequence != acked:
+                # One cumulative ack per read, not one per frame
+                send_frame(client, self.codec.encode({"type": "ack", "data": self.session.last_sequence}))
+
+    def process_received_frame(self, frame, client):
+        if self.session is not None:
+            sequence, frame = split_sequence(frame)
+            if not self.session.accept(sequence):
+                self.stats.increment("duplicates")
+                return
+        self.process_received_payload(frame, client)
+
+    def collect_stats(self):
+        return {"server": self.stats.snapshot(), "injector": self.injector.stats()}
 
     def process_received_payload(self, data_received, client):
-        payload = json.loads(data_received)
-        self.logger.info(f"Received type:{type(payload)} payload:{payload}")
+        start = time.perf_counter_ns()
+        # Timed macros of a session run one after the other, a resumed session keeps its lane
+        lane = self.session or client
+        payload = self.codec.decode(data_received)
+        decoded = self.stats.record_since("decode", start)
+        self.event_logger.info("Received payload: %s", payload)
         payload_type = payload.get("type")
         if payload_type == "SYNC_MACROS":
             self.logger.info(f"Sync Macros requested")
             transactions = payload["data"]
             self.logger.info(f"Applying transactions to DB: {transactions}")
-            self.db_manager.apply_transactions(transactions)
+            apply_sync_macros(self.db_manager, payload)
+        elif payload_type == "SYNC_HELLO":
+            state = build_sync_state(self.db_manager, payload["data"]["db_id"])
+            self.logger.info(f"Sync state requested, we are at revision {state['data']['revision']}")
+            send_frame(client, self.codec.encode(state))
+        elif payload_type == "SYNC_SNAPSHOT":
+            self.logger.info(f"Snapshot of {len(payload['data']['macros'])} macros received")
+            apply_snapshot(self.db_manager, payload)
+        elif payload_type == "codec":
+            self.codec = choose_codec(payload["data"])
+            self.logger.info(f"Client offered codecs {payload['data']}, using {self.codec.name}")
+            send_frame(client, self.codec.name)
         elif payload_type == "exit":
             self.logger.info("Exiting...")
             client.close()
-        elif payload_type == "text":
+        elif payload_type == "stats":
+            send_frame(client, self.codec.encode({"type": "stats", "data": self.collect_stats()}))
+        elif payload_type == "hello":
+            self.session = self.session_registry.create(self.codec)
+            send_frame(client, self.codec.encode(self.hello_reply(self.session)))
+        elif payload_type == "run_macro":
+            payloads = self.expand_macro(payload["data"])
+            if payloads is None:
+                send_frame(client, self.codec.encode({"type": "macro_miss", "data": payload["data"]}))
+            elif any(step["type"] == WAIT_TYPE for step in payloads):
+                self.schedule_sequence(payloads, lane)
+            elif not self.queue_behind_sequence(payloads, lane):
+                for step in payloads:
+                    self.injector.submit(step)
+        elif payload_type == "sequence":
+            self.schedule_sequence(payload["data"], lane)
+        elif payload_type in MOUSE_TYPES:
+            # Cursor updates are only worth something while fresh, they don't wait for a timed macro
+            self.injector.submit(payload)
+        elif payload_type in INJECTION_TYPES:
+            if not self.queue_behind_sequence([payload], lane):
+                self.injector.submit(payload)
+        else:
+            self.event_logger.warning("Unknown payload type: %s", payload_type)
+        self.stats.record_since("dispatch", decoded)
+
+    def inject_payload(self, payload):
+        # Runs on the injector thread, see InputInjector
+        payload_type = payload["type"]
+        if payload_type == "text":
             pyautogui.write(payload["data"])
         elif payload_type == "keys":
             pyautogui.hotkey(*payload["data"])
+        elif payload_type == "key_down":
+            pyautogui.keyDown(payload["data"])
+        elif payload_type == "key_up":
+            pyautogui.keyUp(payload["data"])
         elif payload_type == "mouse_move":
             self.handle_mouse_move(payload)
         elif payload_type == "mouse_move_rel":
             self.handle_mouse_move_relative(payload)
-        else:
-            self.logger.warning(f"Unknown payload type: {payload_type}")
 
     def handle_mouse_move(self, payload):
         x, y = payload["data"]["x"], payload["data"]["y"]
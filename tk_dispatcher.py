@@ -0,0 +1,48 @@
+import queue
+
+from custom_logger import CustomLogger
+from observer_interface import Observer
+
+
+class TkObserverDispatcher(Observer):
+    """
+    Observer that hands transactions over to the Tk main loop instead of running the wrapped observer inline.
+
+    update/update_batch only put the transactions on a queue, so the thread that mutated the DB (for the
+    server that is the socket thread applying a sync) never touches Tk widgets and never waits for them.
+    A callback scheduled with after() drains the queue on the Tk thread and passes everything that piled up
+    to the wrapped observer's update_batch in one call.
+    """
+
+    def __init__(self, root, observer, interval_ms=50, max_batch=2000):
+        self.logger = CustomLogger().get_logger("TkObserverDispatcherClassLogger")
+        self.root = root
+        self.observer = observer
+        self.interval_ms = interval_ms
+        self.max_batch = max_batch
+        self.queue = queue.SimpleQueue()
+        self.root.after(self.interval_ms, self.drain)
+
+    def update(self, transaction):
+        self.queue.put(transaction)
+
+    def update_batch(self, transactions):
+        for transaction in transactions:
+            self.queue.put(transaction)
+
+    def drain(self):
+        batch = []
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            if batch:
+                self.logger.debug(f"Dispatching {len(batch)} transactions to {self.observer}")
+                self.observer.update_batch(batch)
+        except Exception as e:
+            self.logger.error(f"Observer {self.observer} failed on a batch of {len(batch)} transactions: {e}")
+        finally:
+            # Come straight back while there is a backlog, Tk still gets to redraw between batches
+            self.root.after(0 if len(batch) == self.max_batch else self.interval_ms, self.drain)